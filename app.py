@@ -5,14 +5,16 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.dropdown import DropDown
 from kivy.uix.label import Label
 from kivy.clock import Clock
-from kivy.garden.matplotlib.backend_kivyagg import FigureCanvas
 
-import matplotlib
-matplotlib.use('module://kivy.garden.matplotlib.backend_kivy')
-
-import matplotlib.pyplot as plt
+import collections
+import threading
+import time
+import numpy as np
 
+from decimate import pool_axis, reduce_spectrogram
+from renderer import SpectrogramRenderer
 from uhd_fft import UhdFft
+from waterfall_widget import WaterfallWidget
 
 
 class UhdFftApp(App):
@@ -20,8 +22,20 @@ class UhdFftApp(App):
     run_event = None
     btn_run = None
     uhd_fft = None
+    layout = None
+    waterfall = None
+    btn_live = None
+    live_thread = None
+    live_running = False
+    live_event = None
+    live_frames = None
+    live_rows = 8
+    live_width = 1024
+    live_fps = 60
 
     def request_fft(self):
+        if self.live_running:
+            return
         self.canvas.figure.axes[0].clear()
         self.canvas.figure.axes[1].clear()
 
@@ -50,6 +64,74 @@ class UhdFftApp(App):
         self.canvas.figure.axes[1].legend()
         self.canvas.draw()
 
+    def on_stop(self):
+        self.stop_live()
+        self.uhd_fft.stop_continuous()
+
+    def live_worker(self):
+        renderer = SpectrogramRenderer()
+        while self.live_running:
+            try:
+                freq_result = self.uhd_fft.usrp_recv()
+            except Exception as err:
+                print("Error measuring...")
+                print(err)
+                time.sleep(.1)
+                continue
+            rows = reduce_spectrogram(freq_result, self.live_rows,
+                                      self.live_width)
+            renderer.vmin = self.uhd_fft.vmin
+            renderer.vmax = self.uhd_fft.vmax
+            rgba = np.full(rows.shape + (4,), 255, dtype=np.uint8)
+            rgba[..., :3] = renderer.colorize(rows, *rows.shape)
+            avg_power = pool_axis(np.mean(freq_result, axis=0),
+                                  self.live_width, -1, "mean")
+            self.uhd_fft.release(freq_result)
+            self.live_frames.append((rgba, avg_power))
+
+    def live_update(self, dt):
+        frames = []
+        while self.live_frames:
+            frames.append(self.live_frames.popleft())
+        if not frames:
+            return
+        self.waterfall.vmin = self.uhd_fft.vmin
+        self.waterfall.vmax = self.uhd_fft.vmax
+        if len(set(rgba.shape[1] for rgba, _ in frames)) > 1:
+            # fft size changed in between, only keep the newest width
+            frames = frames[-1:]
+        self.waterfall.add_rows(np.concatenate([rgba for rgba, _ in frames]))
+        self.waterfall.set_trace(frames[-1][1])
+
+    def start_live(self):
+        self.live_frames = collections.deque(maxlen=self.live_fps)
+        self.live_running = True
+        self.live_thread = threading.Thread(target=self.live_worker,
+                                            daemon=True)
+        self.live_thread.start()
+        self.live_event = Clock.schedule_interval(self.live_update,
+                                                  1/self.live_fps)
+        self.layout.remove_widget(self.canvas)
+        self.layout.add_widget(self.waterfall, index=len(self.layout.children))
+        self.btn_live.text = "Stop live"
+
+    def stop_live(self):
+        if not self.live_running:
+            return
+        self.live_running = False
+        self.live_thread.join()
+        Clock.unschedule(self.live_event)
+        self.live_event = None
+        self.layout.remove_widget(self.waterfall)
+        self.layout.add_widget(self.canvas, index=len(self.layout.children))
+        self.btn_live.text = "Live"
+
+    def on_btn_live(self, instance):
+        if self.live_running:
+            self.stop_live()
+        else:
+            self.start_live()
+
     def update_interval_callback(self, dt):
         self.request_fft()
 
@@ -67,6 +149,13 @@ class UhdFftApp(App):
             self.btn_run.text = "Stop"
 
     def new_canvas(self):
+        # matplotlib and its kivy backend are only loaded with the first
+        # snapshot canvas
+        import matplotlib
+        matplotlib.use('module://kivy.garden.matplotlib.backend_kivy')
+        import matplotlib.pyplot as plt
+        from kivy.garden.matplotlib.backend_kivyagg import FigureCanvas
+
         with plt.style.context(('dark_background')):
             figure, ax = plt.subplots(2, 1, sharex=True)
             plt.subplots_adjust(hspace=.0)
@@ -107,9 +196,12 @@ class UhdFftApp(App):
         self.uhd_fft = UhdFft(center_freq=796e6,
                               bandwidth=10e6,
                               gain=38)
+        self.uhd_fft.start_continuous()
         self.canvas = self.new_canvas()
+        self.waterfall = WaterfallWidget()
         layout = BoxLayout(orientation='horizontal')
         layout.add_widget(self.canvas)
+        self.layout = layout
 
         settings = BoxLayout(orientation='vertical', size_hint_x=.3)
         settings.add_widget(
@@ -184,8 +276,11 @@ class UhdFftApp(App):
         btn_update.bind(on_press=self.on_btn_update)
         self.btn_run = Button(text='Run', size_hint_y=None, height=30)
         self.btn_run.bind(on_press=self.on_btn_run)
+        self.btn_live = Button(text='Live', size_hint_y=None, height=30)
+        self.btn_live.bind(on_press=self.on_btn_live)
         settings.add_widget(btn_update)
         settings.add_widget(self.btn_run)
+        settings.add_widget(self.btn_live)
         layout.add_widget(settings)
 
         return layout
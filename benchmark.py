@@ -0,0 +1,272 @@
+import argparse
+import http.server
+import json
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+from devices import SimulatedDevice
+from uhd_fft import UhdFft
+from uhd_fft_remote import UhdFftRemote
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # just enough of the server for the remote client: empty params and
+    # results that are read and thrown away
+    protocol_version = "HTTP/1.1"
+    received = 0
+
+    def reply(self, body=b"", status=200, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"0"':
+            self.reply(status=304)
+        else:
+            self.reply(b"{}", headers={"ETag": '"0"',
+                                       "Content-Type": "application/json"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        StandInHandler.received += len(self.rfile.read(length))
+        self.reply()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def run_case(func, duration, min_iterations):
+    # timing pass first, then a single traced call for the peak memory so
+    # tracemalloc does not slow down the timed iterations
+    func()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_iterations or \
+            time.perf_counter() - started < duration:
+        t = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = np.array(timings)
+    return {
+        "iterations": len(timings),
+        "mean_ms": timings.mean()*1e3,
+        "p50_ms": np.percentile(timings, 50)*1e3,
+        "p90_ms": np.percentile(timings, 90)*1e3,
+        "p99_ms": np.percentile(timings, 99)*1e3,
+        "calls_per_s": 1/timings.mean(),
+        "peak_mem_mb": peak/2**20,
+    }
+
+
+def bench_dsp(uhd_fft, fft_sizes, n_samples, duration, min_iterations):
+    results = []
+    for n in n_samples:
+        for fft_size in fft_sizes:
+            with uhd_fft.transaction():
+                uhd_fft.n_samples = n
+                uhd_fft.fft_size = fft_size
+            samples = uhd_fft.capture()
+            n_frames = n // fft_size
+
+            def psd():
+                uhd_fft.release(uhd_fft.spectrogram(samples))
+
+            def usrp_recv():
+                uhd_fft.release(uhd_fft.usrp_recv())
+
+            for name, func in (("psd", psd), ("usrp_recv", usrp_recv)):
+                result = run_case(func, duration, min_iterations)
+                result.update({
+                    "bench": name,
+                    "fft_size": fft_size,
+                    "n_samples": n,
+                    "frames_per_s": n_frames*result["calls_per_s"],
+                    "msps": n*result["calls_per_s"]/1e6,
+                })
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def bench_remote(remote, fft_sizes, n_samples, encodings, compressions,
+                 duration, min_iterations):
+    results = []
+    uhd_fft = remote.uhd_fft
+    for n in n_samples:
+        for fft_size in fft_sizes:
+            with uhd_fft.transaction():
+                uhd_fft.n_samples = n
+                uhd_fft.fft_size = fft_size
+            freq_result = uhd_fft.usrp_recv()
+            freq_result2 = uhd_fft.usrp_recv()
+            case = {"fft_size": fft_size, "n_samples": n}
+
+            cases = [
+                ("ndarray_to_list", {},
+                 lambda: remote.ndarray_to_list(freq_result)),
+            ]
+            for render_mode in ("fast", "pretty"):
+                cases.append(("make_plot", {"render_mode": render_mode},
+                              lambda render_mode=render_mode:
+                              make_plot(remote, render_mode, freq_result,
+                                        freq_result2)))
+            for encoding in encodings:
+                for compression in (compressions if encoding != "json"
+                                    else ["none"]):
+                    cases.append((
+                        "send_result",
+                        {"encoding": encoding, "compression": compression},
+                        lambda encoding=encoding, compression=compression:
+                        send_result(remote, encoding, compression,
+                                    freq_result, freq_result2)))
+
+            for name, options, func in cases:
+                sent = StandInHandler.received
+                result = run_case(func, duration, min_iterations)
+                result.update(case)
+                result.update(options)
+                result["bench"] = name
+                result["frames_per_s"] = len(freq_result) * \
+                    result["calls_per_s"]
+                if name == "send_result":
+                    result["payload_kb"] = (StandInHandler.received - sent) / \
+                        (result["iterations"] + 2)/1e3
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def make_plot(remote, render_mode, freq_result, freq_result2):
+    remote.render_mode = render_mode
+    return remote.make_plot(freq_result, freq_result2)
+
+
+def send_result(remote, encoding, compression, freq_result, freq_result2):
+    # forced here instead of negotiated through the stand-in's params
+    remote.render_mode = "fast"
+    remote.encoding = encoding
+    remote.binary_supported = True
+    remote.params = {"compression": {"raw": compression}}
+    return remote.send_result(freq_result, freq_result2)
+
+
+def print_result(result):
+    options = ", ".join("%s=%s" % (k, result[k])
+                        for k in ("fft_size", "n_samples", "render_mode",
+                                  "encoding", "compression") if k in result)
+    print("%-16s %-52s %9.2f ms p50 %9.2f ms p99 %10.1f frames/s %7.1f MB" %
+          (result["bench"], options, result["p50_ms"], result["p99_ms"],
+           result["frames_per_s"], result["peak_mem_mb"]))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return tuple(str(result.get(k)) for k in
+                 ("bench", "fft_size", "n_samples", "render_mode",
+                  "encoding", "compression"))
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    print("\nCompared to %s (p50, >1 is faster now):" % baseline_path)
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old:
+            name = " ".join(v for v in case_key(result) if v != "None")
+            print("%-60s %6.2fx" % (name,
+                                    old["p50_ms"]/result["p50_ms"]))
+
+
+def int_list(text):
+    return [int(float(v)) for v in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='UHD FFT benchmarks')
+    parser.add_argument("--fft-sizes", type=int_list, default=[256, 1024, 4096],
+                        help="Comma separated FFT sizes")
+    parser.add_argument("--n-samples", type=int_list, default=[int(1e4),
+                                                              int(1e5)],
+                        help="Comma separated capture sizes")
+    parser.add_argument("--encodings", type=str, default="json,f32,f16,u8",
+                        help="Comma separated result encodings")
+    parser.add_argument("--compressions", type=str, default="none,deflate",
+                        help="Comma separated compressions of binary results")
+    parser.add_argument("--fft-backend", type=str, default="numpy",
+                        choices=["numpy", "scipy", "pyfftw"],
+                        help="FFT backend")
+    parser.add_argument("--duration", type=float, default=1.0,
+                        help="Seconds spent on every case")
+    parser.add_argument("--min-iterations", type=int, default=5,
+                        help="Minimum iterations of every case")
+    parser.add_argument("--skip-remote", action="store_true",
+                        help="Only run the DSP benchmarks")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json",
+                        help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Print the speedup against an earlier result file")
+    args = parser.parse_args()
+
+    device = SimulatedDevice(realtime=False)
+    results = []
+    if args.skip_remote:
+        uhd_fft = UhdFft(796e6, 10e6, 38, fft_backend=args.fft_backend,
+                         device=device)
+        results += bench_dsp(uhd_fft, args.fft_sizes, args.n_samples,
+                             args.duration, args.min_iterations)
+    else:
+        server, base_url = start_stand_in()
+        remote = UhdFftRemote(base_url, "bench", fft_backend=args.fft_backend,
+                              device=device)
+        results += bench_dsp(remote.uhd_fft, args.fft_sizes, args.n_samples,
+                             args.duration, args.min_iterations)
+        results += bench_remote(remote, args.fft_sizes, args.n_samples,
+                                args.encodings.split(","),
+                                args.compressions.split(","),
+                                args.duration, args.min_iterations)
+        remote.params_channel.running = False
+        server.shutdown()
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "fft_backend": args.fft_backend,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % args.output)
+    if args.compare:
+        compare(results, args.compare)
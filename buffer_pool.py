@@ -0,0 +1,63 @@
+import threading
+import weakref
+import numpy as np
+
+
+class BufferPool():
+    # Reusable arrays keyed by (shape, dtype). acquire() hands a buffer to
+    # the caller, who owns it until it is given back with release(); after
+    # that it may be handed out again at any time, so nothing (including
+    # views of it) may be used past release(). Buffers that are never
+    # released are simply garbage collected, the pool only keeps track of
+    # the ones it has handed out so foreign arrays are ignored on release.
+    _free = None
+    _owned = None
+    _lock = None
+    max_free = 4
+
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self._free = {}
+        self._owned = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(shape, dtype):
+        return tuple(shape), np.dtype(dtype).str
+
+    def acquire(self, shape, dtype=np.float32):
+        key = self.key(shape, dtype)
+        with self._lock:
+            free = self._free.get(key)
+            buf = free.pop() if free else None
+            if buf is None:
+                buf = np.empty(key[0], dtype=dtype)
+            self._owned[id(buf)] = buf
+        return buf
+
+    def release(self, buf):
+        # views are traced back to the pooled array they were taken from
+        with self._lock:
+            while buf is not None and id(buf) not in self._owned:
+                buf = buf.base if isinstance(buf.base, np.ndarray) else None
+            if buf is None:
+                return False
+            del self._owned[id(buf)]
+            free = self._free.setdefault(self.key(buf.shape, buf.dtype), [])
+            if len(free) < self.max_free:
+                free.append(buf)
+        return True
+
+    def clear(self):
+        # drop the idle buffers, e.g. after the capture or FFT size changed;
+        # buffers still handed out can be released and reused later
+        with self._lock:
+            self._free.clear()
+
+    @property
+    def n_free(self):
+        return sum(len(free) for free in self._free.values())
+
+    @property
+    def n_owned(self):
+        return len(self._owned)
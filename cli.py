@@ -1,14 +1,120 @@
+import argparse
+from devices import make_device
+from recorder import SpectrogramStore
+from sweep import SweepEngine
 from uhd_fft import UhdFft
 
-import matplotlib.pyplot as plt
+
+def plot_sweep(uhd_fft, result):
+    import matplotlib.pyplot as plt
+    f, ax = plt.subplots(2, 1, sharex=True)
+    plt.subplots_adjust(hspace=.0)
+    freqs = result["freqs"]/1e6
+    ax[0].pcolormesh(freqs, range(len(result["waterfall"])),
+                     result["waterfall"], cmap=plt.get_cmap("inferno"),
+                     vmax=uhd_fft.vmax, vmin=uhd_fft.vmin)
+    ax[0].set_ylabel("Frame")
+    ax[1].plot(freqs, result["spectrum"])
+    ax[1].set_xlabel("Frequency [MHz]")
+    ax[1].set_ylabel("Power [dB]")
+
+
+def plot_recording(segments):
+    import matplotlib.pyplot as plt
+    f, ax = plt.subplots(2, 1, sharex=True)
+    plt.subplots_adjust(hspace=.0)
+    t_first = min(segment["times"][0] for segment in segments)
+    for segment in segments:
+        freqs = segment["freqs"]/1e6
+        ax[0].pcolormesh(freqs, segment["times"] - t_first,
+                         segment["frames"], cmap=plt.get_cmap("inferno"))
+        ax[1].plot(freqs, segment["frames"].mean(axis=0))
+    ax[0].set_ylabel("Time [s]")
+    ax[1].set_xlabel("Frequency [MHz]")
+    ax[1].set_ylabel("Power [dB]")
+
+
+def finish_plot(args):
+    import matplotlib.pyplot as plt
+    if args.save:
+        plt.savefig(args.save)
+    if args.show:
+        plt.show()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='UHD FFT')
+    parser.add_argument("-d", "--device", type=str, default="uhd",
+                        help="Device: uhd[:args], sim or replay:<file>")
+    parser.add_argument("--sweep", type=float, nargs=2, default=None,
+                        metavar=("START", "STOP"),
+                        help="Sweep and stitch START to STOP MHz")
+    parser.add_argument("--zoom", type=float, nargs=2, default=None,
+                        metavar=("FREQ", "SPAN"),
+                        help="Only transform the SPAN MHz around FREQ MHz")
+    parser.add_argument("--pfb-taps", type=int, default=0,
+                        help="Polyphase filter bank taps, 0 for a plain FFT")
+    parser.add_argument("--show", action="store_true",
+                        help="Show the plot")
+    parser.add_argument("--save", type=str, default=None, metavar="FILE",
+                        help="Save the plot to FILE")
+    parser.add_argument("--record", type=str, default=None, metavar="DIR",
+                        help="Append the capture to this store")
+    parser.add_argument("--play", type=str, default=None, metavar="DIR",
+                        help="Plot recorded frames instead of measuring")
+    parser.add_argument("--range", type=float, nargs=2, default=(None, None),
+                        metavar=("START", "END"),
+                        help="Unix time range of the recorded frames")
+    parser.add_argument("--band", type=float, nargs=2, default=(None, None),
+                        metavar=("FMIN", "FMAX"),
+                        help="Frequency range of the recorded frames in MHz")
+    parser.add_argument("--timed", action="store_true",
+                        help="Capture at scheduled device times, with the "
+                        "device clock set to the host time")
+    args = parser.parse_args()
+    # matplotlib is only loaded when there is a plot to show or save
+    plotting = args.show or args.save
+
+    if args.play:
+        store = SpectrogramStore(args.play)
+        fmin, fmax = [None if f is None else f*1e6 for f in args.band]
+        segments = store.query(*args.range, fmin, fmax)
+        print("%d frames in %d chunks" %
+              (sum(len(s["frames"]) for s in segments), len(segments)))
+        if segments and plotting:
+            plot_recording(segments)
+            finish_plot(args)
+        raise SystemExit
+
     uhd_fft = UhdFft(center_freq=796e6,
                      bandwidth=10e6,
-                     gain=38)
-    freq_result = uhd_fft.usrp_recv()
-    # uhd_fft.plot(freq_result)
-    fig, ax = plt.subplots()
-    uhd_fft.plot_avg_power(ax, freq_result)
-    # plt.show()
+                     gain=38,
+                     device=make_device(args.device))
+    with uhd_fft.transaction():
+        uhd_fft.pfb_taps = args.pfb_taps
+        if args.zoom:
+            uhd_fft.zoom_freq = args.zoom[0]*1e6
+            uhd_fft.zoom_span = args.zoom[1]*1e6
+    if args.timed:
+        uhd_fft.enable_timed()
+    if args.sweep:
+        engine = SweepEngine(uhd_fft, args.sweep[0]*1e6, args.sweep[1]*1e6)
+        result = engine.sweep()
+        print("Swept %d hops in %.2f s" %
+              (len(result["hops"]), result["duration"]))
+        if plotting:
+            plot_sweep(uhd_fft, result)
+    else:
+        freq_result = uhd_fft.usrp_recv()
+        if args.record:
+            store = SpectrogramStore(args.record, writable=True)
+            store.record(uhd_fft, freq_result)
+            store.close()
+        if plotting:
+            import matplotlib.pyplot as plt
+            # uhd_fft.plot(freq_result)
+            fig, ax = plt.subplots()
+            uhd_fft.plot_avg_power(ax, freq_result)
+    if plotting:
+        finish_plot(args)
     # print(uhd_fft._freq_res)
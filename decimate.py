@@ -0,0 +1,44 @@
+import numpy as np
+
+POOLS = {
+    "max": np.maximum,
+    "min": np.minimum,
+    "mean": np.add,
+}
+
+
+def pool_axis(matrix, n_out, axis, mode="max"):
+    if mode not in POOLS:
+        raise ValueError("Unknown pooling %s, available: %s" %
+                         (mode, ", ".join(POOLS)))
+    axis = axis % matrix.ndim
+    n_in = matrix.shape[axis]
+    if not n_out or n_out >= n_in:
+        return matrix
+
+    ufunc = POOLS[mode]
+    if n_in % n_out == 0:
+        # equal sized windows: reduce over a reshaped view
+        factor = n_in // n_out
+        shape = matrix.shape[:axis] + (n_out, factor) + matrix.shape[axis+1:]
+        result = ufunc.reduce(matrix.reshape(shape), axis=axis+1)
+        if mode == "mean":
+            result /= factor
+        return result
+
+    edges = (np.arange(n_out)*n_in) // n_out
+    result = ufunc.reduceat(matrix, edges, axis=axis)
+    if mode == "mean":
+        counts = np.diff(np.append(edges, n_in))
+        shape = [1]*matrix.ndim
+        shape[axis] = n_out
+        result /= counts.reshape(shape)
+    return result
+
+
+def reduce_spectrogram(freq_result, height=None, width=None,
+                       time_mode="max", freq_mode="max"):
+    # (..., frames, bins) -> (..., <=height, <=width); max pooling keeps
+    # narrowband peaks and short bursts visible at display resolution
+    result = pool_axis(freq_result, width, -1, freq_mode)
+    return pool_axis(result, height, -2, time_mode)
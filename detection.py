@@ -0,0 +1,198 @@
+import numpy as np
+
+METHODS = ("floor", "cfar")
+
+
+def find_runs(mask):
+    # horizontal runs of set cells of a (rows, cols) mask: row, first and
+    # last column of every run, in row major order
+    n_rows, n_cols = mask.shape
+    padded = np.zeros((n_rows, n_cols + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - 1
+
+
+def label_runs(rows, starts, ends, n_cols):
+    # 4-connected regions from runs: runs in consecutive rows that overlap
+    # belong together. The runs of the row above that overlap a run are a
+    # contiguous range of the row major run list, so all links are found
+    # with two binary searches, then labels are merged to the smallest run
+    # index by min propagation with pointer jumping.
+    n_runs = len(rows)
+    labels = np.arange(n_runs)
+    if not n_runs:
+        return labels
+    start_keys = rows*n_cols + starts
+    end_keys = rows*n_cols + ends
+    above = (rows - 1)*n_cols
+    lo = np.searchsorted(end_keys, above + starts, "left")
+    hi = np.searchsorted(start_keys, above + ends, "right")
+    counts = np.maximum(hi - lo, 0)
+    n_links = counts.sum()
+    if not n_links:
+        return labels
+    first = np.cumsum(counts) - counts
+    a = np.repeat(np.arange(n_runs), counts)
+    b = np.repeat(lo, counts) + np.arange(n_links) - np.repeat(first, counts)
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        if np.array_equal(labels[a], labels[b]):
+            break
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        labels = labels[labels]
+    return labels
+
+
+def label_regions(mask):
+    # runs of the mask and the region (0..n_regions-1) of every run
+    rows, starts, ends = find_runs(mask)
+    labels = label_runs(rows, starts, ends, mask.shape[1])
+    _, labels = np.unique(labels, return_inverse=True)
+    return rows, starts, ends, labels.reshape(-1)
+
+
+class Detector():
+    # Finds bursts in a (frames, bins) spectrogram in signed dB. A cell is occupied
+    # when it is `threshold` dB above its noise estimate. With "floor" that
+    # is the median of its bin over the frames, smoothed across calls and
+    # capped at `ripple` dB above the median of all bins so that bins with
+    # a continuous carrier keep the floor of their neighbours. With "cfar"
+    # it is the mean power of `train` cells on both sides of it in the same
+    # frame, leaving `guard` cells next to it out (cell averaging CFAR),
+    # which copes with an uneven floor but misses signals wider than the
+    # training window. Occupied cells are grouped into 4-connected
+    # regions, each region is one event. Regions of fewer than `min_cells`
+    # cells are dropped and only the `max_events` strongest are kept.
+    method = "floor"
+    threshold = 10.0
+    ripple = 6.0
+    guard = 2
+    train = 16
+    floor_alpha = 0.1
+    min_cells = 3
+    max_events = 256
+    noise_level = None
+    _floor = None
+    _band = None
+
+    def __init__(self, method="floor", threshold=10.0, guard=2, train=16,
+                 floor_alpha=0.1, ripple=6.0, min_cells=3, max_events=256):
+        if method not in METHODS:
+            raise ValueError("Unknown detector %s, available: %s" %
+                             (method, ", ".join(METHODS)))
+        self.method = method
+        self.threshold = threshold
+        self.guard = guard
+        self.train = train
+        self.floor_alpha = floor_alpha
+        self.ripple = ripple
+        self.min_cells = min_cells
+        self.max_events = max_events
+
+    def cfar_mask(self, freq_result):
+        power = np.power(10, freq_result/10, dtype=np.float64)
+        n_frames, n_bins = power.shape
+        sums = np.zeros((n_frames, n_bins + 1))
+        np.cumsum(power, axis=1, out=sums[:, 1:])
+        bins = np.arange(n_bins)
+
+        def window(lo, hi):
+            lo = np.clip(lo, 0, n_bins)
+            hi = np.clip(hi, 0, n_bins)
+            return sums[:, hi] - sums[:, lo], hi - lo
+
+        lead, n_lead = window(bins - self.guard - self.train,
+                              bins - self.guard)
+        lag, n_lag = window(bins + self.guard + 1,
+                            bins + self.guard + 1 + self.train)
+        noise = lead + lag
+        noise /= np.maximum(n_lead + n_lag, 1)
+        self.noise_level = 10*np.log10(np.median(noise) or 1e-30)
+        noise *= 10**(self.threshold/10)
+        return power > noise
+
+    def floor_mask(self, freq_result):
+        floor = np.median(freq_result, axis=0)
+        np.minimum(floor, np.median(floor) + self.ripple, out=floor)
+        if self._floor is None or self._floor.shape != floor.shape or \
+                not self.floor_alpha:
+            self._floor = floor
+        else:
+            self._floor += self.floor_alpha*(floor - self._floor)
+        self.noise_level = float(np.median(self._floor))
+        return freq_result > self._floor + self.threshold
+
+    def mask(self, freq_result):
+        if self.method == "cfar":
+            return self.cfar_mask(freq_result)
+        return self.floor_mask(freq_result)
+
+    def detect(self, freq_result, t_start, time_res, center_freq, freq_res):
+        # events of one spectrogram whose first frame starts at t_start,
+        # bins are fftshift-ed around center_freq
+        n_frames, n_bins = freq_result.shape
+        band = (center_freq, freq_res, n_bins)
+        if band != self._band:
+            # the floor learned on another band does not apply to this one
+            self._floor = None
+            self._band = band
+        mask = self.mask(freq_result)
+        rows, starts, ends, labels = label_regions(mask)
+        if not len(labels):
+            return []
+        n_regions = labels.max() + 1
+
+        # per cell: region, frame, bin and power, in the order of the runs
+        lengths = ends - starts + 1
+        cell_labels = np.repeat(labels, lengths)
+        cell_rows = np.repeat(rows, lengths)
+        cell_bins = np.repeat(starts - np.cumsum(lengths) + lengths,
+                              lengths) + np.arange(lengths.sum())
+        cell_db = freq_result[cell_rows, cell_bins]
+
+        n_cells = np.bincount(cell_labels, minlength=n_regions)
+        keep = np.nonzero(n_cells >= self.min_cells)[0]
+        if not len(keep):
+            return []
+        linear = np.bincount(cell_labels, np.power(10, cell_db/10),
+                             minlength=n_regions)
+        peak = np.full(n_regions, -np.inf)
+        np.maximum.at(peak, cell_labels, cell_db)
+        first_row = np.full(n_regions, n_frames)
+        np.minimum.at(first_row, cell_labels, cell_rows)
+        last_row = np.zeros(n_regions, dtype=int)
+        np.maximum.at(last_row, cell_labels, cell_rows)
+        low_bin = np.full(n_regions, n_bins)
+        np.minimum.at(low_bin, cell_labels, cell_bins)
+        high_bin = np.zeros(n_regions, dtype=int)
+        np.maximum.at(high_bin, cell_labels, cell_bins)
+        # first cell at the peak of every region
+        at_peak = np.nonzero(cell_db == peak[cell_labels])[0]
+        _, first_peak = np.unique(cell_labels[at_peak], return_index=True)
+        peak_bin = cell_bins[at_peak[first_peak]]
+
+        keep = keep[np.argsort(-peak[keep], kind="stable")][:self.max_events]
+        avg_db = 10*np.log10(linear/n_cells)
+        bin_freq = center_freq - n_bins//2*freq_res
+        events = []
+        for i in keep:
+            low = bin_freq + low_bin[i]*freq_res
+            high = bin_freq + high_bin[i]*freq_res
+            events.append({
+                "t_start": float(t_start + first_row[i]*time_res),
+                "duration": float((last_row[i] - first_row[i] + 1)*time_res),
+                "center_freq": round(float(low + high)/2, 1),
+                "bandwidth": round(float(high - low + freq_res), 1),
+                "peak_freq": round(float(bin_freq + peak_bin[i]*freq_res), 1),
+                "peak_power": round(float(peak[i]), 2),
+                "avg_power": round(float(avg_db[i]), 2),
+                "cells": int(n_cells[i]),
+                # may continue in the previous or next capture
+                "clipped": bool(first_row[i] == 0 or
+                                last_row[i] == n_frames - 1),
+            })
+        return events
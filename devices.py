@@ -0,0 +1,589 @@
+import collections
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+class Device():
+    # Subset of the MultiUSRP API that UhdFft relies on. Streamers returned
+    # by get_rx_stream() provide recv(buffer, metadata, timeout),
+    # issue_stream_cmd(cmd) and get_max_num_samps() like uhd's rx_streamer.
+    # Times are device time in seconds; between set_command_time() and
+    # clear_command_time() antenna, tune and gain changes are carried out
+    # by the device at that time instead of right away.
+    name = "device"
+
+    def get_rx_num_channels(self):
+        raise NotImplementedError
+
+    def get_rx_antennas(self, channel=0):
+        raise NotImplementedError
+
+    def get_rx_antenna(self, channel=0):
+        raise NotImplementedError
+
+    def set_rx_antenna(self, name, channel=0):
+        raise NotImplementedError
+
+    def get_rx_freq(self, channel=0):
+        raise NotImplementedError
+
+    def tune(self, freq, lo_offset=0.0, channel=0, cached=None):
+        # cached: result of an earlier identical tune to replay verbatim
+        raise NotImplementedError
+
+    def set_rx_gain(self, gain, channel=0):
+        raise NotImplementedError
+
+    def set_rx_rate(self, rate, channel=0):
+        raise NotImplementedError
+
+    def get_rx_stream(self, channels):
+        raise NotImplementedError
+
+    def stream_cmd(self, mode, num_samps=0, time=None):
+        # time None streams now, num_samps is used by the num_* modes
+        raise NotImplementedError
+
+    def rx_metadata(self):
+        raise NotImplementedError
+
+    def rx_status(self, metadata):
+        raise NotImplementedError
+
+    def rx_time(self, metadata):
+        # device time of the first sample of the last recv
+        raise NotImplementedError
+
+    def get_time_now(self):
+        raise NotImplementedError
+
+    def set_time_now(self, time):
+        raise NotImplementedError
+
+    def set_command_time(self, time):
+        raise NotImplementedError
+
+    def clear_command_time(self):
+        raise NotImplementedError
+
+
+class UsrpDevice(Device):
+    name = "uhd"
+    _uhd = None
+    _usrp = None
+
+    def __init__(self, args=""):
+        import uhd
+        self._uhd = uhd
+        self._usrp = uhd.usrp.MultiUSRP(args)
+
+    def get_rx_num_channels(self):
+        return self._usrp.get_rx_num_channels()
+
+    def get_rx_antennas(self, channel=0):
+        return self._usrp.get_rx_antennas(channel)
+
+    def get_rx_antenna(self, channel=0):
+        return self._usrp.get_rx_antenna(channel)
+
+    def set_rx_antenna(self, name, channel=0):
+        self._usrp.set_rx_antenna(name, channel)
+
+    def get_rx_freq(self, channel=0):
+        return self._usrp.get_rx_freq(channel)
+
+    def tune(self, freq, lo_offset=0.0, channel=0, cached=None):
+        tune_req = self._uhd.types.TuneRequest(freq, lo_offset)
+        if cached is not None:
+            # skip the tuning calculation and reuse the known LO/DSP split
+            manual = self._uhd.types.TuneRequestPolicy.manual
+            tune_req.rf_freq_policy = manual
+            tune_req.rf_freq = cached.actual_rf_freq
+            tune_req.dsp_freq_policy = manual
+            tune_req.dsp_freq = cached.actual_dsp_freq
+        return self._usrp.set_rx_freq(tune_req, channel)
+
+    def set_rx_gain(self, gain, channel=0):
+        self._usrp.set_rx_gain(gain, channel)
+
+    def set_rx_rate(self, rate, channel=0):
+        self._usrp.set_rx_rate(rate, channel)
+
+    def get_rx_stream(self, channels):
+        st_args = self._uhd.usrp.StreamArgs("fc32", "sc16")
+        st_args.channels = channels
+        return self._usrp.get_rx_stream(st_args)
+
+    def time_spec(self, time):
+        # whole and fractional seconds apart, a double alone loses sub-us
+        # precision at unix times
+        return self._uhd.types.TimeSpec(int(time), time - int(time))
+
+    def stream_cmd(self, mode, num_samps=0, time=None):
+        cmd = self._uhd.types.StreamCMD(
+            getattr(self._uhd.types.StreamMode, mode))
+        if num_samps:
+            cmd.num_samps = num_samps
+        if time is not None:
+            cmd.stream_now = False
+            cmd.time_spec = self.time_spec(time)
+        return cmd
+
+    def rx_metadata(self):
+        return self._uhd.types.RXMetadata()
+
+    def rx_status(self, metadata):
+        return metadata.error_code.name
+
+    def rx_time(self, metadata):
+        return metadata.time_spec.get_real_secs()
+
+    def get_time_now(self):
+        return self._usrp.get_time_now().get_real_secs()
+
+    def set_time_now(self, time):
+        self._usrp.set_time_now(self.time_spec(time))
+
+    def set_command_time(self, time):
+        self._usrp.set_command_time(self.time_spec(time))
+
+    def clear_command_time(self):
+        self._usrp.clear_command_time()
+
+
+class SimStreamCmd():
+    stream_mode = None
+    num_samps = 0
+    stream_now = True
+    time_spec = 0.0
+
+    def __init__(self, stream_mode, num_samps=0, time=None):
+        self.stream_mode = stream_mode
+        self.num_samps = num_samps
+        if time is not None:
+            self.stream_now = False
+            self.time_spec = time
+
+
+class SimRxMetadata():
+    error_code = "none"
+    time_spec = 0.0
+    end_of_burst = False
+
+    def strerror(self):
+        return "ERROR_CODE_%s" % self.error_code.upper()
+
+
+class SimTuneResult():
+    actual_rf_freq = 0.0
+    actual_dsp_freq = 0.0
+
+    def __init__(self, actual_rf_freq, actual_dsp_freq=0.0):
+        self.actual_rf_freq = actual_rf_freq
+        self.actual_dsp_freq = actual_dsp_freq
+
+
+class SimStreamer():
+    # Samples are addressed by device time: sample k of a stream started at
+    # device time t is read from position round(t*rate) + k. Bursts of
+    # num_done commands are queued and streamed one after another, each
+    # from its own start time.
+    _device = None
+    _channels = None
+    _max_num_samps = 2000
+    _streaming = False
+    _position = 0
+    _remaining = None
+    _bursts = None
+
+    def __init__(self, device, channels, max_num_samps=2000):
+        self._device = device
+        self._channels = list(channels)
+        self._max_num_samps = max_num_samps
+        self._bursts = collections.deque()
+
+    def get_max_num_samps(self):
+        return self._max_num_samps
+
+    def issue_stream_cmd(self, cmd):
+        now = self._device.get_time_now()
+        time = now if cmd.stream_now else cmd.time_spec
+        if cmd.stream_mode == "start_cont":
+            self._streaming = True
+            self._remaining = None
+            self._position = self._device.sample_at(max(time, now))
+        elif cmd.stream_mode == "stop_cont":
+            self._streaming = False
+            self._bursts.clear()
+        elif cmd.stream_mode == "num_done":
+            # a command for the past is rejected when its burst comes up
+            self._bursts.append((time, cmd.num_samps, time < now))
+
+    def start_burst(self, metadata):
+        time, num_samps, late = self._bursts.popleft()
+        if late:
+            metadata.error_code = "late"
+            return False
+        self._streaming = True
+        self._remaining = num_samps
+        self._position = self._device.sample_at(time)
+        return True
+
+    def recv(self, buffer, metadata, timeout=0.1):
+        metadata.end_of_burst = False
+        if not self._streaming and self._bursts:
+            if not self.start_burst(metadata):
+                return 0
+        if not self._streaming:
+            time.sleep(min(timeout, 0.01))
+            metadata.error_code = "timeout"
+            return 0
+
+        # like uhd, which would fill a temporary copy of anything else
+        if not buffer.flags.c_contiguous:
+            raise ValueError("recv needs a C-contiguous buffer")
+        device = self._device
+        buffer = buffer.reshape(len(self._channels), -1)
+        n_samples = buffer.shape[1]
+        if self._remaining is not None:
+            n_samples = min(n_samples, self._remaining)
+        # settings scheduled within the block apply from their sample on
+        command_at = device.next_command_sample()
+        if command_at is not None and command_at > self._position:
+            n_samples = min(n_samples, command_at - self._position)
+        if device.realtime:
+            due = device.monotonic_at((self._position + n_samples)/device.rate)
+            delay = due - time.monotonic()
+            if delay > timeout:
+                n_samples = max(0, int(n_samples*timeout/delay))
+                delay = timeout
+            if delay > 0:
+                time.sleep(delay)
+            if not n_samples:
+                metadata.error_code = "timeout"
+                return 0
+
+        device.run_commands(self._position)
+        for i, channel in enumerate(self._channels):
+            device.read_samples(channel, self._position,
+                                buffer[i, :n_samples])
+        device.advance((self._position + n_samples)/device.rate)
+        metadata.error_code = "none"
+        metadata.time_spec = self._position/device.rate
+        self._position += n_samples
+        if self._remaining is not None:
+            self._remaining -= n_samples
+            if not self._remaining:
+                self._streaming = False
+                metadata.end_of_burst = True
+        return n_samples
+
+
+class SimDevice(Device):
+    # The device clock follows the host's monotonic clock in realtime mode;
+    # otherwise it is virtual and only moves as samples are read or a
+    # stream is started in the future.
+    name = "sim"
+    rate = 1e6
+    realtime = True
+    _antennas = ("TX/RX", "RX2")
+    _num_channels = 2
+    _freq = None
+    _gain = None
+    _antenna = None
+    _lock = None
+    _clock_base = 0.0
+    _virtual_time = 0.0
+    _command_time = None
+    _commands = None
+
+    def __init__(self, realtime=True, num_channels=2):
+        self.realtime = realtime
+        self._num_channels = num_channels
+        self._freq = [0.0]*num_channels
+        self._gain = [0.0]*num_channels
+        self._antenna = [self._antennas[0]]*num_channels
+        self._lock = threading.Lock()
+        self._clock_base = time.monotonic()
+        self._commands = []
+
+    def get_time_now(self):
+        if self.realtime:
+            return time.monotonic() - self._clock_base
+        return self._virtual_time
+
+    def set_time_now(self, time_now):
+        self._clock_base = time.monotonic() - time_now
+        self._virtual_time = time_now
+
+    def monotonic_at(self, device_time):
+        return self._clock_base + device_time
+
+    def advance(self, device_time):
+        if device_time > self._virtual_time:
+            self._virtual_time = device_time
+
+    def sample_at(self, device_time):
+        return int(round(device_time*self.rate))
+
+    def set_command_time(self, time):
+        self._command_time = time
+
+    def clear_command_time(self):
+        self._command_time = None
+
+    def command(self, func, *args):
+        # run now or queue for the command time
+        if self._command_time is None:
+            func(*args)
+            return
+        with self._lock:
+            self._commands.append((self._command_time, func, args))
+            self._commands.sort(key=lambda command: command[0])
+
+    def next_command_sample(self):
+        with self._lock:
+            if not self._commands:
+                return None
+            return int(np.ceil(self._commands[0][0]*self.rate))
+
+    def run_commands(self, position):
+        while True:
+            with self._lock:
+                if not self._commands or \
+                        self._commands[0][0]*self.rate > position:
+                    return
+                _, func, args = self._commands.pop(0)
+            func(*args)
+
+    def get_rx_num_channels(self):
+        return self._num_channels
+
+    def get_rx_antennas(self, channel=0):
+        return list(self._antennas)
+
+    def get_rx_antenna(self, channel=0):
+        return self._antenna[channel]
+
+    def set_rx_antenna(self, name, channel=0):
+        if name not in self._antennas:
+            raise ValueError("Unknown antenna %s" % name)
+        self.command(self._antenna.__setitem__, channel, name)
+
+    def get_rx_freq(self, channel=0):
+        return self._freq[channel]
+
+    def tune(self, freq, lo_offset=0.0, channel=0, cached=None):
+        self.command(self._freq.__setitem__, channel, float(freq))
+        return SimTuneResult(float(freq + lo_offset), float(lo_offset))
+
+    def set_rx_gain(self, gain, channel=0):
+        self.command(self._gain.__setitem__, channel, float(gain))
+
+    def set_rx_rate(self, rate, channel=0):
+        self.rate = float(rate)
+
+    def get_rx_stream(self, channels):
+        return SimStreamer(self, channels)
+
+    def stream_cmd(self, mode, num_samps=0, time=None):
+        return SimStreamCmd(mode, num_samps, time)
+
+    def rx_metadata(self):
+        return SimRxMetadata()
+
+    def rx_status(self, metadata):
+        return metadata.error_code
+
+    def rx_time(self, metadata):
+        return metadata.time_spec
+
+    def read_samples(self, channel, position, out):
+        raise NotImplementedError
+
+
+class SimulatedDevice(SimDevice):
+    # Synthetic signal source: continuous tones, white noise and LTE-like
+    # bursts where every 1 ms subframe occupies a random set of 180 kHz
+    # resource blocks. Frequencies are absolute, so retuning moves them.
+    name = "sim"
+    subframe = 1e-3
+    resource_block = 180e3
+    ref_gain = 38.0
+    antenna_gain = {"TX/RX": -3.0, "RX2": 0.0}
+    _tones = None
+    _bursts = None
+    _noise_db = -60.0
+    _seed = 0
+    _subframe_cache = None
+
+    def __init__(self, tones=None, bursts=None, noise_db=-60.0,
+                 realtime=True, num_channels=2, seed=0):
+        SimDevice.__init__(self, realtime, num_channels)
+        self._tones = tones if tones is not None else [
+            (796.5e6, -20.0), (801.2e6, -30.0)]
+        # (center, bandwidth, power_db, occupancy, duty cycle)
+        self._bursts = bursts if bursts is not None else [
+            (796e6, 10e6, -35.0, 0.3, 0.2)]
+        self._noise_db = noise_db
+        self._seed = seed
+        self._subframe_cache = {}
+
+    def amplitude(self, channel):
+        gain_db = self._gain[channel] - self.ref_gain + \
+            self.antenna_gain.get(self._antenna[channel], 0.0)
+        return 10**(gain_db/20)
+
+    def read_samples(self, channel, position, out):
+        n_samples = len(out)
+        rng = np.random.default_rng((self._seed, channel, position))
+        noise_amp = 10**(self._noise_db/20)/np.sqrt(2)
+        noise = rng.standard_normal((2, n_samples), dtype=np.float32)
+        out.real = noise[0]
+        out.imag = noise[1]
+        out *= noise_amp
+
+        center = self._freq[channel]
+        # the phase restarts every second (exact for whole Hz offsets), so
+        # positions at unix times keep their precision
+        t = (position % int(self.rate) + np.arange(n_samples))/self.rate
+        for freq, power_db in self._tones:
+            offset = freq - center
+            if abs(offset) < self.rate/2:
+                out += (10**(power_db/20) *
+                        np.exp(2j*np.pi*offset*t)).astype(np.complex64)
+
+        if self._bursts:
+            self.add_bursts(channel, position, out)
+        out *= self.amplitude(channel)
+
+    def add_bursts(self, channel, position, out):
+        sf_len = max(1, int(self.rate*self.subframe))
+        end = position + len(out)
+        for k in range(position // sf_len, (end - 1) // sf_len + 1):
+            block = self.burst_subframe(channel, k, sf_len)
+            if block is None:
+                continue
+            a = max(position, k*sf_len)
+            b = min(end, (k + 1)*sf_len)
+            out[a-position:b-position] += block[a-k*sf_len:b-k*sf_len]
+
+    def burst_subframe(self, channel, index, sf_len):
+        key = (channel, index, sf_len, self._freq[channel], self.rate)
+        with self._lock:
+            if key in self._subframe_cache:
+                return self._subframe_cache[key]
+
+        rng = np.random.default_rng((self._seed + 1, index))
+        bin_width = self.rate/sf_len
+        spectrum = np.zeros(sf_len, dtype=np.complex64)
+        active = False
+        for center, bandwidth, power_db, occupancy, duty in self._bursts:
+            if rng.random() >= duty:
+                continue
+            n_rb = max(1, int(bandwidth/self.resource_block))
+            occupied = np.flatnonzero(rng.random(n_rb) < occupancy)
+            rb_bins = max(1, int(self.resource_block/bin_width))
+            first = center - bandwidth/2 - self._freq[channel]
+            starts = np.round((first + occupied*self.resource_block) /
+                              bin_width).astype(int)
+            idx = (starts[:, None] + np.arange(rb_bins)).ravel()
+            idx = idx[np.abs(idx) < sf_len//2] % sf_len
+            amp = 10**(power_db/20)*np.sqrt(sf_len/2)
+            spectrum[idx] += amp*(rng.standard_normal(len(idx)) +
+                                  1j*rng.standard_normal(len(idx)))
+            active = active or len(idx) > 0
+
+        block = np.fft.ifft(spectrum).astype(np.complex64) if active else None
+        with self._lock:
+            if len(self._subframe_cache) > 64:
+                self._subframe_cache.clear()
+            self._subframe_cache[key] = block
+        return block
+
+
+class ReplayDevice(SimDevice):
+    # Plays back raw cf32 files or SigMF recordings through a memory map.
+    # Tuning and rate changes are accepted but do not alter the recording.
+    name = "replay"
+    center_freq = None
+    _path = None
+    _data = None
+    _loop = True
+
+    def __init__(self, path, rate=None, center_freq=None, realtime=False,
+                 loop=True):
+        data_path, meta = self.open_metadata(path)
+        num_channels = int(meta.get("core:num_channels", 1))
+        SimDevice.__init__(self, realtime, num_channels)
+        self._path = data_path
+        self._loop = loop
+        self.rate = float(rate or meta.get("core:sample_rate", self.rate))
+        self.center_freq = center_freq or meta.get("core:frequency")
+        samples = np.memmap(data_path, dtype=np.complex64, mode="r")
+        self._data = samples[:len(samples)//num_channels*num_channels] \
+            .reshape(-1, num_channels).T
+        if self.center_freq is not None:
+            self._freq = [float(self.center_freq)]*num_channels
+
+    @staticmethod
+    def open_metadata(path):
+        base, ext = os.path.splitext(path)
+        if ext not in (".sigmf-meta", ".sigmf-data"):
+            return path, {}
+        with open(base + ".sigmf-meta") as f:
+            meta = json.load(f)
+        info = dict(meta.get("global", {}))
+        datatype = info.get("core:datatype", "cf32_le")
+        if datatype != "cf32_le":
+            raise ValueError("Unsupported SigMF datatype %s" % datatype)
+        captures = meta.get("captures", [])
+        if captures and "core:frequency" in captures[0]:
+            info["core:frequency"] = captures[0]["core:frequency"]
+        return base + ".sigmf-data", info
+
+    def set_rx_rate(self, rate, channel=0):
+        if float(rate) != self.rate:
+            print("Replaying %s at its recorded rate of %.2f MS/s" %
+                  (self._path, self.rate/1e6))
+
+    def read_samples(self, channel, position, out):
+        total = self._data.shape[1]
+        n_samples = len(out)
+        if not self._loop:
+            # zeros past the end of the recording
+            n = max(0, min(n_samples, total - position))
+            out[:n] = self._data[channel, position:position+n]
+            out[n:] = 0
+            return
+        done = 0
+        while done < n_samples:
+            idx = (position + done) % total
+            n = min(n_samples - done, total - idx)
+            out[done:done+n] = self._data[channel, idx:idx+n]
+            done += n
+
+
+DEVICES = {
+    UsrpDevice.name: UsrpDevice,
+    SimulatedDevice.name: SimulatedDevice,
+    ReplayDevice.name: ReplayDevice,
+}
+
+
+def make_device(spec="uhd", realtime=None):
+    name, _, args = spec.partition(":")
+    if name not in DEVICES:
+        raise ValueError("Unknown device %s, available: %s" %
+                         (name, ", ".join(DEVICES)))
+    if name == UsrpDevice.name:
+        return UsrpDevice(args)
+    kwargs = {}
+    if realtime is not None:
+        kwargs["realtime"] = realtime
+    if name == ReplayDevice.name:
+        return ReplayDevice(args, **kwargs)
+    return SimulatedDevice(**kwargs)
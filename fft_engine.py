@@ -0,0 +1,175 @@
+import threading
+import numpy as np
+
+
+class NumpyFftBackend():
+    name = "numpy"
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    def fft(self, frames):
+        return np.fft.fft(frames, axis=-1).astype(np.complex64, copy=False)
+
+
+class ScipyFftBackend():
+    name = "scipy"
+
+    def __init__(self, workers=-1):
+        import scipy.fft
+        self._scipy_fft = scipy.fft
+        self.workers = workers
+
+    def fft(self, frames):
+        return self._scipy_fft.fft(frames, axis=-1, overwrite_x=True,
+                                   workers=self.workers)
+
+
+class PyfftwFftBackend():
+    name = "pyfftw"
+    planner_effort = "FFTW_MEASURE"
+
+    def __init__(self, workers=1):
+        import pyfftw
+        self._pyfftw = pyfftw
+        self._plans = {}
+        self.workers = workers
+
+    def plan(self, shape):
+        # plans own their output array, so every thread gets its own
+        key = (shape, threading.get_ident())
+        plan = self._plans.get(key)
+        if plan is None:
+            # planning with FFTW_MEASURE clobbers its input, so plan on a
+            # scratch array and feed the real frames in at call time
+            scratch = self._pyfftw.empty_aligned(shape, dtype=np.complex64)
+            plan = self._pyfftw.builders.fft(
+                scratch, axis=-1, threads=max(1, self.workers),
+                planner_effort=self.planner_effort)
+            self._plans[key] = plan
+        return plan
+
+    def fft(self, frames):
+        # the returned array is owned by the plan and reused on the next call
+        return self.plan(frames.shape)(frames)
+
+
+FFT_BACKENDS = {
+    NumpyFftBackend.name: NumpyFftBackend,
+    ScipyFftBackend.name: ScipyFftBackend,
+    PyfftwFftBackend.name: PyfftwFftBackend,
+}
+
+WINDOWS = {
+    "hamming": np.hamming,
+    "hann": np.hanning,
+    "blackman": np.blackman,
+    "rect": np.ones,
+}
+
+
+class FftEngine():
+    _backend = None
+    _windows = None
+
+    @property
+    def backend(self):
+        return self._backend.name
+
+    @property
+    def workers(self):
+        return self._backend.workers
+
+    def __init__(self, backend="numpy", workers=1):
+        self._windows = {}
+        self.set_backend(backend, workers)
+
+    def set_backend(self, backend, workers=1):
+        if backend not in FFT_BACKENDS:
+            raise ValueError("Unknown FFT backend %s, available: %s" %
+                             (backend, ", ".join(FFT_BACKENDS)))
+        self._backend = FFT_BACKENDS[backend](workers)
+
+    def get_window(self, fft_size, window="hamming"):
+        key = (fft_size, window)
+        coeffs = self._windows.get(key)
+        if coeffs is None:
+            if window not in WINDOWS:
+                raise ValueError("Unknown window %s, available: %s" %
+                                 (window, ", ".join(WINDOWS)))
+            coeffs = WINDOWS[window](fft_size).astype(np.float32)
+            self._windows[key] = coeffs
+        return coeffs
+
+    @staticmethod
+    def frames(samples, fft_size):
+        # (..., n_samples) -> (..., n_frames, fft_size), e.g. one
+        # spectrogram per channel for stacked multi-channel captures
+        samples = np.asarray(samples, dtype=np.complex64)
+        n_frames = samples.shape[-1] // fft_size
+        return samples[..., :n_frames*fft_size].reshape(
+            samples.shape[:-1] + (n_frames, fft_size))
+
+    def get_pfb_window(self, fft_size, taps, window="hamming"):
+        # prototype low pass of a taps x fft_size polyphase filter bank,
+        # one row per tap
+        key = ("pfb", fft_size, taps, window)
+        coeffs = self._windows.get(key)
+        if coeffs is None:
+            n = np.arange(taps*fft_size)
+            coeffs = np.sinc((n - taps*fft_size/2)/fft_size) * \
+                self.get_window(taps*fft_size, window)
+            coeffs = coeffs.reshape(taps, fft_size).astype(np.float32)
+            self._windows[key] = coeffs
+        return coeffs
+
+    def psd(self, samples, fft_size, window="hamming", out=None,
+            folded=True):
+        frames = self.frames(samples, fft_size)
+        if out is None:
+            out = np.empty(frames.shape, dtype=np.float32)
+
+        windowed = np.multiply(frames, self.get_window(fft_size, window),
+                               dtype=np.complex64)
+        return self.spectrum_db(self._backend.fft(windowed), out, folded)
+
+    def pfb_psd(self, samples, fft_size, taps=4, window="hamming", out=None,
+                folded=True):
+        # Polyphase filter bank: every frame is the weighted sum of `taps`
+        # consecutive blocks, which gives each bin a flat top and far less
+        # leakage into its neighbours than a single windowed block. Frames
+        # still advance by fft_size, the first taps-1 blocks only feed the
+        # filter.
+        blocks = self.frames(samples, fft_size)
+        n_frames = blocks.shape[-2] - taps + 1
+        if n_frames < 1:
+            raise ValueError("A %d tap filter bank needs at least %d "
+                             "samples, got %d" % (taps, taps*fft_size,
+                                                  samples.shape[-1]))
+        coeffs = self.get_pfb_window(fft_size, taps, window)
+        if out is None:
+            out = np.empty(blocks.shape[:-2] + (n_frames, fft_size),
+                           dtype=np.float32)
+
+        summed = np.multiply(blocks[..., :n_frames, :], coeffs[0],
+                             dtype=np.complex64)
+        for tap in range(1, taps):
+            summed += blocks[..., tap:tap+n_frames, :]*coeffs[tap]
+        return self.spectrum_db(self._backend.fft(summed), out, folded)
+
+    @staticmethod
+    def spectrum_db(spectrum, out, folded=True):
+        # magnitude straight into the fftshift-ed positions, then
+        # 10*log10(|X|^2) == 20*log10(|X|) in place. folded gives |dB|,
+        # which loses whether a bin is above or below 0 dB
+        fft_size = spectrum.shape[-1]
+        half = fft_size // 2
+        np.abs(spectrum[..., :fft_size - half], out=out[..., half:])
+        np.abs(spectrum[..., fft_size - half:], out=out[..., :half])
+        with np.errstate(divide="ignore"):
+            np.log10(out, out=out)
+        out *= 20.0
+        np.nan_to_num(out, copy=False)
+        if folded:
+            np.abs(out, out=out)
+        return out
@@ -0,0 +1,323 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import requests
+
+from metrics import Metrics, MetricsServer
+
+# Example config, device specs as in make_device(), options are passed on
+# to UhdFftRemote:
+# {
+#     "base_url": "http://localhost:8000",
+#     "upload_workers": 4,
+#     "devices": [
+#         {"device": "uhd:serial=3164A1B", "room": "roof", "cpus": [1]},
+#         {"device": "uhd:addr=192.168.10.2", "room": "lab", "cpus": [2],
+#          "options": {"continuous": true, "encoding": "u8"}}
+#     ]
+# }
+
+
+def device_main(spec, base_url, uploads, binary_rejected, stop):
+    # runs in the acquisition process of one device
+    from devices import make_device
+    from uhd_fft_remote import UhdFftRemote
+
+    class FleetRemote(UhdFftRemote):
+        # results are handed to the parent's upload scheduler
+        def upload_result(self, meta, body, content_type):
+            if binary_rejected.is_set():
+                self.binary_supported = False
+            try:
+                uploads.put_nowait((self.room_id, body, content_type,
+                                    meta["wire"] is not None))
+            except queue.Full:
+                self.metrics.inc("fleet_queue_full")
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if spec.get("cpus") and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, spec["cpus"])
+
+    remote = FleetRemote(base_url, spec["room"],
+                         device=make_device(spec.get("device", "uhd"),
+                                            spec.get("realtime")),
+                         **spec.get("options", {}))
+
+    def wait_for_stop():
+        stop.wait()
+        remote.running = False
+    threading.Thread(target=wait_for_stop, daemon=True).start()
+    try:
+        remote.measurement_worker()
+    finally:
+        # do not block the exit on results the parent will never read
+        uploads.cancel_join_thread()
+        remote.params_channel.running = False
+        remote.uhd_fft.stop_continuous()
+
+
+class UploadScheduler():
+    # One keep-alive connection pool for every room. Each room has a
+    # single pending slot: a newer result replaces one that has not been
+    # sent yet, so a slow uplink drops stale frames instead of queueing
+    # them. Rooms are served in the order their results arrived and never
+    # have two uploads in flight, which keeps every room's frames in order.
+    base_url = ""
+    workers = 4
+    session = None
+    metrics = None
+    on_rejected = None
+    running = False
+    uploaded = None
+    dropped = None
+    errors = None
+    _pending = None
+    _busy = None
+    _cond = None
+    _threads = None
+
+    def __init__(self, base_url, workers=4, metrics=None, on_rejected=None):
+        self.base_url = base_url
+        self.workers = workers
+        self.metrics = metrics or Metrics()
+        self.on_rejected = on_rejected
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.uploaded = collections.Counter()
+        self.dropped = collections.Counter()
+        self.errors = collections.Counter()
+        self._pending = collections.OrderedDict()
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, room, body, content_type, binary=False):
+        with self._cond:
+            if room in self._pending:
+                self.dropped[room] += 1
+                del self._pending[room]
+            self._pending[room] = (body, content_type, binary)
+            self._cond.notify()
+
+    def next_upload(self):
+        with self._cond:
+            while self.running:
+                for room in self._pending:
+                    if room not in self._busy:
+                        self._busy.add(room)
+                        return (room,) + self._pending.pop(room)
+                self._cond.wait(0.1)
+        return None
+
+    def upload(self, room, body, content_type, binary):
+        url = "%s/result?room=%s" % (self.base_url, room)
+        try:
+            with self.metrics.timer("upload"):
+                resp = self.session.post(
+                    url, data=body, headers={"Content-Type": content_type})
+        except requests.RequestException as err:
+            self.errors[room] += 1
+            print("Error uploading %s..." % room)
+            print(err)
+            return
+        if resp.status_code >= 400:
+            self.errors[room] += 1
+            if binary and self.on_rejected:
+                self.on_rejected(room)
+            return
+        self.uploaded[room] += 1
+
+    def upload_worker(self):
+        while self.running:
+            upload = self.next_upload()
+            if upload is None:
+                continue
+            try:
+                self.upload(*upload)
+            finally:
+                with self._cond:
+                    self._busy.discard(upload[0])
+                    self._cond.notify()
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.upload_worker,
+                                      name="upload-%d" % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class DeviceWorker():
+    spec = None
+    process = None
+    binary_rejected = None
+    restarts = 0
+    backoff = 0
+    started_at = None
+    next_start = 0
+
+    def __init__(self, spec, binary_rejected):
+        self.spec = spec
+        self.binary_rejected = binary_rejected
+
+    @property
+    def room(self):
+        return self.spec["room"]
+
+
+class Fleet():
+    # Supervises one acquisition process per device. Processes come from a
+    # fork server that has the acquisition modules preloaded, so they start
+    # quickly and share those pages. A process that dies is restarted with
+    # exponential backoff, which resets once it ran for `stable_time`.
+    base_url = ""
+    min_backoff = 1.0
+    max_backoff = 60.0
+    stable_time = 60.0
+    queue_size = 16
+    running = False
+    workers = None
+    scheduler = None
+    metrics = None
+    _ctx = None
+    _uploads = None
+    _stop = None
+
+    def __init__(self, config):
+        rooms = [spec["room"] for spec in config["devices"]]
+        if len(set(rooms)) != len(rooms):
+            raise ValueError("Every device needs its own room: %s" %
+                             ", ".join(rooms))
+        self.base_url = config.get("base_url", "http://localhost:8000")
+        self.min_backoff = config.get("min_backoff", self.min_backoff)
+        self.max_backoff = config.get("max_backoff", self.max_backoff)
+        self.queue_size = config.get("queue_size", self.queue_size)
+
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._ctx = multiprocessing.get_context("forkserver")
+            self._ctx.set_forkserver_preload(["devices", "uhd_fft_remote"])
+        else:
+            self._ctx = multiprocessing.get_context("spawn")
+        self._uploads = self._ctx.Queue(self.queue_size)
+        self._stop = self._ctx.Event()
+        self.workers = {}
+        for spec in config["devices"]:
+            if "args" in spec:
+                spec = dict(spec, device="uhd:%s" % spec["args"])
+            self.workers[spec["room"]] = DeviceWorker(spec, self._ctx.Event())
+
+        self.metrics = Metrics(prefix="uhd_fft_fleet")
+        self.metrics.gauge("alive", lambda: {
+            room: int(bool(worker.process and worker.process.is_alive()))
+            for room, worker in self.workers.items()}, label="room")
+        self.metrics.gauge("restarts", lambda: {
+            room: worker.restarts for room, worker in self.workers.items()},
+            label="room")
+        self.scheduler = UploadScheduler(
+            self.base_url, config.get("upload_workers", 4), self.metrics,
+            on_rejected=self.on_rejected)
+        for name in ("uploaded", "dropped", "errors"):
+            self.metrics.gauge(name, getattr(self.scheduler, name).copy,
+                               label="room")
+
+    def on_rejected(self, room):
+        print("Server rejected binary result of %s, using JSON" % room)
+        self.workers[room].binary_rejected.set()
+
+    def start_worker(self, worker):
+        worker.process = self._ctx.Process(
+            target=device_main, name="fleet-%s" % worker.room,
+            args=(worker.spec, self.base_url, self._uploads,
+                  worker.binary_rejected, self._stop))
+        worker.process.start()
+        worker.started_at = time.monotonic()
+
+    def check_worker(self, worker):
+        now = time.monotonic()
+        if worker.process is None:
+            if now >= worker.next_start:
+                self.start_worker(worker)
+            return
+        if worker.process.is_alive():
+            if worker.backoff and now - worker.started_at > self.stable_time:
+                worker.backoff = 0
+            return
+        worker.backoff = min(self.max_backoff,
+                             2*worker.backoff if worker.backoff
+                             else self.min_backoff)
+        print("Device of %s exited with %s, restarting in %.1f s" %
+              (worker.room, worker.process.exitcode, worker.backoff))
+        worker.process = None
+        worker.restarts += 1
+        worker.next_start = now + worker.backoff
+
+    def collect_worker(self):
+        while self.running:
+            try:
+                upload = self._uploads.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.scheduler.submit(*upload)
+
+    def run(self):
+        self.running = True
+        self.scheduler.start()
+        collector = threading.Thread(target=self.collect_worker, daemon=True)
+        collector.start()
+        try:
+            while self.running:
+                for worker in self.workers.values():
+                    self.check_worker(worker)
+                time.sleep(0.5)
+        finally:
+            self.stop()
+            collector.join()
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        for worker in self.workers.values():
+            if worker.process:
+                worker.process.join(10)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        self.scheduler.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='UHD FFT fleet runner')
+    parser.add_argument("config", type=str,
+                        help="JSON config mapping devices to rooms")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve the fleet metrics on this port")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        fleet = Fleet(json.load(f))
+    server = None
+    if args.metrics_port:
+        server = MetricsServer(fleet.metrics, args.metrics_port).start()
+    try:
+        fleet.run()
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        if server:
+            server.stop()
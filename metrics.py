@@ -0,0 +1,245 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+# upper bounds in seconds, from a single small FFT up to a slow upload
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1., 2.5, 5., 10.)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram():
+    buckets = LATENCY_BUCKETS
+    counts = None
+    count = 0
+    total = 0.
+    max = 0.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # one extra slot for everything above the last bound (+Inf)
+        self.counts = [0]*(len(self.buckets) + 1)
+
+    def observe(self, val):
+        self.counts[bisect.bisect_left(self.buckets, val)] += 1
+        self.count += 1
+        self.total += val
+        self.max = max(self.max, val)
+
+    def quantile(self, q):
+        # linear interpolation inside the bucket the quantile falls into
+        if not self.count:
+            return None
+        rank = q*self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.buckets[i - 1] if i else 0.
+                high = min(self.buckets[i], self.max) \
+                    if i < len(self.buckets) else self.max
+                low = min(low, high)
+                return low + (high - low)*(rank - seen)/n
+            seen += n
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total/self.count if self.count else None,
+            "p50": self.quantile(.5),
+            "p90": self.quantile(.9),
+            "p99": self.quantile(.99),
+            "max": self.max,
+        }
+
+
+class RateMeter():
+    # events per second, exponentially smoothed over the intervals
+    alpha = 0.1
+    rate = 0.
+    _last = None
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+
+    def tick(self):
+        now = time.monotonic()
+        if self._last is not None and now > self._last:
+            rate = 1/(now - self._last)
+            self.rate = rate if not self.rate else \
+                self.rate + self.alpha*(rate - self.rate)
+        self._last = now
+        return self.rate
+
+
+class Metrics():
+    # Latency histograms, counters and gauges of one sensor. Gauges are
+    # either set directly or read from a callable when a snapshot is
+    # taken; a callable may return a dict, which becomes one labelled
+    # series per key (e.g. queue depth per pipeline stage).
+    prefix = "uhd_fft"
+    _histograms = None
+    _counters = None
+    _gauges = None
+    _rates = None
+    _lock = None
+
+    def __init__(self, prefix="uhd_fft"):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_gauge(self, name, val, label=None):
+        self._gauges[name] = (val, label)
+
+    def gauge(self, name, func, label=None):
+        self._gauges[name] = (func, label)
+
+    def tick(self, name):
+        # achieved rate of an event, exposed as the gauge `name`
+        with self._lock:
+            meter = self._rates.get(name)
+            if meter is None:
+                meter = self._rates[name] = RateMeter()
+            meter.tick()
+        self.set_gauge(name, meter.rate)
+
+    def gauge_values(self):
+        values = {}
+        for name, (val, label) in list(self._gauges.items()):
+            if callable(val):
+                try:
+                    val = val()
+                except Exception:
+                    continue
+            if val is not None:
+                values[name] = (val, label)
+        return values
+
+    def totals(self):
+        # (count, sum) of every histogram, for rates over an interval
+        with self._lock:
+            return {name: (histogram.count, histogram.total)
+                    for name, histogram in self._histograms.items()}
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {name: histogram.summary()
+                          for name, histogram in self._histograms.items()}
+            counters = dict(self._counters)
+        return {
+            "histograms": histograms,
+            "counters": counters,
+            "gauges": {name: val
+                       for name, (val, _) in self.gauge_values().items()},
+        }
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                metric = "%s_%s_seconds" % (self.prefix, name)
+                lines.append("# TYPE %s histogram" % metric)
+                cumulative = 0
+                for bound, n in zip(self.buckets_le(histogram),
+                                    histogram.counts):
+                    cumulative += n
+                    lines.append('%s_bucket{le="%s"} %d' %
+                                 (metric, bound, cumulative))
+                lines.append("%s_sum %r" % (metric, histogram.total))
+                lines.append("%s_count %d" % (metric, histogram.count))
+            for name, val in sorted(self._counters.items()):
+                metric = "%s_%s_total" % (self.prefix, name)
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %d" % (metric, val))
+        for name, (val, label) in sorted(self.gauge_values().items()):
+            metric = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s gauge" % metric)
+            if isinstance(val, dict):
+                for key, v in sorted(val.items()):
+                    lines.append('%s{%s="%s"} %r' %
+                                 (metric, label or "name", key, float(v)))
+            else:
+                lines.append("%s %r" % (metric, float(val)))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def buckets_le(histogram):
+        return ["%g" % bound for bound in histogram.buckets] + ["+Inf"]
+
+
+class MetricsServer():
+    # /metrics in the Prometheus text format, /metrics.json as JSON
+    metrics = None
+    host = "0.0.0.0"
+    port = 9105
+    _server = None
+    _thread = None
+
+    def __init__(self, metrics, port=9105, host="0.0.0.0"):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+
+    def start(self):
+        import http.server
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    body = metrics.prometheus().encode()
+                    content_type = PROMETHEUS_CONTENT_TYPE
+                elif path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port),
+                                                       Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,139 @@
+import json
+import time
+import requests
+
+POLL = "poll"
+LONG_POLL = "longpoll"
+SSE = "sse"
+MODES = (POLL, LONG_POLL, SSE)
+
+
+def param_changes(old, new):
+    changes = {}
+    for k, v in new.items():
+        if not isinstance(v, dict) or "raw" not in v:
+            continue
+        prev = old.get(k)
+        if not isinstance(prev, dict) or prev.get("raw") != v["raw"]:
+            changes[k] = v["raw"]
+    return changes
+
+
+class ParamsChannel():
+    # Keeps the room params in sync over one keep-alive session. poll uses
+    # conditional GETs (ETag / If-None-Match), longpoll asks the server to
+    # hold the request until the params version changes and sse listens to
+    # a /params/stream event stream. on_change only sees the params whose
+    # raw value actually changed.
+    base_url = ""
+    room_id = "test"
+    mode = POLL
+    interval = 0.25
+    wait = 30
+    retry_interval = 1.0
+    params = None
+    etag = None
+    running = True
+    room_created = False
+    on_change = None
+    session = None
+    metrics = None
+
+    def __init__(self, base_url, room_id, mode=POLL, interval=0.25, wait=30,
+                 on_change=None):
+        if mode not in MODES:
+            raise ValueError("Unknown params mode %s, available: %s" %
+                             (mode, ", ".join(MODES)))
+        self.base_url = base_url
+        self.room_id = room_id
+        self.mode = mode
+        self.interval = interval
+        self.wait = wait
+        self.on_change = on_change
+        self.params = {}
+        self.session = requests.Session()
+
+    @property
+    def url(self):
+        return "%s/params?room=%s" % (self.base_url, self.room_id)
+
+    def create_room(self):
+        self.session.post("%s/create_room?room=%s" %
+                          (self.base_url, self.room_id))
+        self.room_created = True
+
+    def update(self, params, etag=None):
+        self.etag = etag
+        changes = param_changes(self.params, params)
+        self.params = params
+        if changes and self.on_change:
+            self.on_change(changes)
+        return changes
+
+    def conditional_headers(self):
+        return {"If-None-Match": self.etag} if self.etag else {}
+
+    def poll(self):
+        resp = self.session.get(self.url, headers=self.conditional_headers(),
+                                timeout=10)
+        if resp.status_code == 304:
+            return {}
+        resp.raise_for_status()
+        return self.update(resp.json(), resp.headers.get("ETag"))
+
+    def long_poll(self):
+        resp = self.session.get("%s&wait=%d" % (self.url, self.wait),
+                                headers=self.conditional_headers(),
+                                timeout=self.wait + 10)
+        if resp.status_code == 304:
+            return {}
+        resp.raise_for_status()
+        if "ETag" not in resp.headers:
+            # plain /params endpoint, the server does not hold requests
+            print("Server does not support long polling, polling instead")
+            self.mode = POLL
+        return self.update(resp.json(), resp.headers.get("ETag"))
+
+    def listen(self):
+        url = "%s/params/stream?room=%s" % (self.base_url, self.room_id)
+        headers = {"Accept": "text/event-stream"}
+        if self.etag:
+            headers["Last-Event-ID"] = self.etag
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=(10, None)) as resp:
+            if resp.status_code == 404:
+                print("Server does not support params streaming, polling instead")
+                self.mode = POLL
+                return
+            resp.raise_for_status()
+            event_id = None
+            data = []
+            for line in resp.iter_lines(decode_unicode=True):
+                if not self.running:
+                    return
+                if line.startswith("id:"):
+                    event_id = line[3:].strip()
+                elif line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif not line and data:
+                    self.update(json.loads("\n".join(data)), event_id)
+                    data = []
+
+    def run(self):
+        while self.running:
+            try:
+                if not self.room_created:
+                    self.create_room()
+                if self.mode == SSE:
+                    self.listen()
+                elif self.mode == LONG_POLL:
+                    self.long_poll()
+                else:
+                    self.poll()
+                    time.sleep(self.interval)
+            except Exception as err:
+                if self.metrics:
+                    self.metrics.inc("params_errors")
+                print("Error receiving remote params...")
+                print(err)
+                time.sleep(self.retry_interval)
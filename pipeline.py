@@ -0,0 +1,135 @@
+import collections
+import queue
+import threading
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class BoundedQueue():
+    maxsize = 2
+    policy = DROP_OLDEST
+    dropped = 0
+    closed = False
+    _items = None
+    _cond = None
+
+    def __init__(self, maxsize=2, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy %s, available: %s" %
+                             (policy, ", ".join(POLICIES)))
+        self.maxsize = max(1, int(maxsize))
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif not self._cond.wait_for(
+                        lambda: len(self._items) < self.maxsize or self.closed,
+                        timeout) or self.closed:
+                    return False
+            self._items.append(item)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed,
+                                       timeout) or not self._items:
+                raise queue.Empty
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class Stage():
+    name = None
+    func = None
+    workers = 1
+    queue = None
+
+    def __init__(self, name, func, workers=1, queue_size=2,
+                 policy=DROP_OLDEST):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue = BoundedQueue(queue_size, policy)
+
+
+class Pipeline():
+    # Chain of stages connected by bounded queues. Every stage pulls from
+    # its own queue with its own worker threads and pushes the non-None
+    # results into the next stage's queue, so a slow stage only ever fills
+    # (and drops from) the queue in front of it.
+    stages = None
+    running = False
+    _threads = None
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._threads = []
+
+    def put(self, item, timeout=None):
+        return self.stages[0].queue.put(item, timeout)
+
+    def start(self):
+        self.running = True
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.stage_worker, args=(i,),
+                    name="%s-%d" % (stage.name, n), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for stage in self.stages:
+            stage.queue.close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stage_worker(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] \
+            if index + 1 < len(self.stages) else None
+        while self.running:
+            try:
+                item = stage.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                result = stage.func(item)
+            except Exception as err:
+                print("Error in %s stage..." % stage.name)
+                print(err)
+                continue
+            if next_stage and result is not None:
+                next_stage.queue.put(result)
+
+    def queue_depths(self):
+        return {stage.name: len(stage.queue) for stage in self.stages}
+
+    def dropped(self):
+        return {stage.name: stage.queue.dropped for stage in self.stages}
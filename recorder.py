@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# one record per chunk, kept in memory and rewritten in place while the
+# chunk is being filled
+INDEX_DTYPE = np.dtype([
+    ("chunk", "<u4"),
+    ("n_frames", "<u4"),
+    ("t_start", "<f8"),
+    ("t_end", "<f8"),
+    ("f_start", "<f8"),
+    ("f_end", "<f8"),
+    ("fft_size", "<u4"),
+    ("gain", "<f4"),
+])
+
+# a new chunk is started whenever one of these changes
+META_KEYS = ("center_freq", "bandwidth", "fft_size", "time_res", "gain",
+             "antenna")
+
+
+class SpectrogramStore():
+    # Directory of chunks, each a float32 (frames, fft_size) file plus the
+    # float64 timestamp of every frame and a small JSON with the settings
+    # the frames were taken with. index.bin holds one fixed size record
+    # per chunk (time span, frequency span), so a query only touches the
+    # chunks it overlaps and reads them through memory maps.
+    path = None
+    chunk_frames = 4096
+    writable = False
+    _index = None
+    _index_file = None
+    _chunk = None
+    _meta_cache = None
+    _lock = None
+
+    def __init__(self, path, writable=False, chunk_frames=4096):
+        self.path = path
+        self.writable = writable
+        self.chunk_frames = chunk_frames
+        self._meta_cache = {}
+        self._lock = threading.Lock()
+        index_path = os.path.join(path, "index.bin")
+        if writable:
+            os.makedirs(path, exist_ok=True)
+            # records are rewritten in place, so no append mode
+            self._index_file = open(index_path, "r+b"
+                                    if os.path.exists(index_path) else "w+b")
+        if os.path.exists(index_path):
+            self._index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+        elif not writable:
+            raise IOError("No spectrogram store at %s" % path)
+        else:
+            self._index = np.empty(0, dtype=INDEX_DTYPE)
+
+    @property
+    def index(self):
+        return self._index
+
+    def chunk_path(self, chunk, ext):
+        return os.path.join(self.path, "chunk_%08d.%s" % (chunk, ext))
+
+    def chunk_meta(self, chunk):
+        meta = self._meta_cache.get(chunk)
+        if meta is None:
+            with open(self.chunk_path(chunk, "json")) as f:
+                meta = self._meta_cache[chunk] = json.load(f)
+        return meta
+
+    def open_chunk(self, meta):
+        chunk = len(self._index)
+        with open(self.chunk_path(chunk, "json"), "w") as f:
+            json.dump(meta, f)
+        self._meta_cache[chunk] = meta
+        # sparse until written, trimmed to the actual length on close
+        frames = np.memmap(self.chunk_path(chunk, "f32"), dtype=np.float32,
+                           mode="w+",
+                           shape=(self.chunk_frames, meta["fft_size"]))
+        times = np.memmap(self.chunk_path(chunk, "times"), dtype=np.float64,
+                          mode="w+", shape=(self.chunk_frames,))
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record["chunk"] = chunk
+        record["f_start"] = meta["center_freq"] - meta["bandwidth"]/2
+        record["f_end"] = meta["center_freq"] + meta["bandwidth"]/2
+        record["fft_size"] = meta["fft_size"]
+        record["gain"] = meta["gain"]
+        self._index = np.concatenate([self._index, record])
+        self._chunk = {"id": chunk, "meta": meta, "frames": frames,
+                       "times": times, "count": 0}
+        self.write_record(chunk)
+
+    def close_chunk(self):
+        chunk = self._chunk
+        if chunk is None:
+            return
+        self._chunk = None
+        count = chunk["count"]
+        for name, ext in (("frames", "f32"), ("times", "times")):
+            data = chunk.pop(name)
+            data.flush()
+            row_bytes = data.strides[0]
+            del data
+            os.truncate(self.chunk_path(chunk["id"], ext), count*row_bytes)
+
+    def write_record(self, chunk):
+        self._index_file.seek(chunk*INDEX_DTYPE.itemsize)
+        self._index_file.write(self._index[chunk:chunk+1].tobytes())
+        self._index_file.flush()
+
+    def append(self, freq_result, timestamp, meta):
+        # freq_result (frames, fft_size) starting at `timestamp`, meta with
+        # the META_KEYS it was taken with
+        if not self.writable:
+            raise IOError("Spectrogram store %s is read only" % self.path)
+        meta = {k: meta[k] for k in META_KEYS}
+        times = timestamp + np.arange(len(freq_result))*meta["time_res"]
+        with self._lock:
+            pos = 0
+            while pos < len(freq_result):
+                chunk = self._chunk
+                if chunk is None or chunk["meta"] != meta or \
+                        chunk["count"] == self.chunk_frames:
+                    self.close_chunk()
+                    self.open_chunk(meta)
+                    chunk = self._chunk
+                count = chunk["count"]
+                n = min(len(freq_result) - pos, self.chunk_frames - count)
+                chunk["frames"][count:count+n] = freq_result[pos:pos+n]
+                chunk["times"][count:count+n] = times[pos:pos+n]
+                record = self._index[chunk["id"]]
+                if not count:
+                    record["t_start"] = times[pos]
+                record["t_end"] = times[pos+n-1]
+                record["n_frames"] = count + n
+                chunk["count"] = count + n
+                self.write_record(chunk["id"])
+                pos += n
+
+    def record(self, uhd_fft, freq_result, timestamp=None):
+        # with no timestamp the frames are from the last capture
+        if timestamp is None:
+            timestamp = uhd_fft.capture_time
+        # the band the bins cover, the zoom band when zoomed
+        self.append(freq_result, timestamp, {
+            "center_freq": uhd_fft.view_center_freq,
+            "bandwidth": uhd_fft.fft_size*uhd_fft.freq_res,
+            "fft_size": uhd_fft.fft_size,
+            "time_res": uhd_fft.time_res,
+            "gain": uhd_fft.gain,
+            "antenna": uhd_fft.antenna_name,
+        })
+
+    def load_chunk(self, chunk):
+        record = self._index[chunk]
+        n_frames = int(record["n_frames"])
+        frames = np.memmap(self.chunk_path(chunk, "f32"), dtype=np.float32,
+                           mode="r", shape=(n_frames, int(record["fft_size"])))
+        times = np.memmap(self.chunk_path(chunk, "times"), dtype=np.float64,
+                          mode="r", shape=(n_frames,))
+        return frames, times
+
+    def query(self, t0=None, t1=None, f0=None, f1=None):
+        # segments of the frames in [t0, t1] and the bins in [f0, f1], the
+        # frames are memory mapped views
+        with self._lock:
+            index = self._index.copy()
+        t0 = -np.inf if t0 is None else t0
+        t1 = np.inf if t1 is None else t1
+        f0 = -np.inf if f0 is None else f0
+        f1 = np.inf if f1 is None else f1
+        hits = (index["n_frames"] > 0) & \
+            (index["t_end"] >= t0) & (index["t_start"] <= t1) & \
+            (index["f_end"] >= f0) & (index["f_start"] <= f1)
+
+        segments = []
+        for record in index[hits]:
+            chunk = int(record["chunk"])
+            frames, times = self.load_chunk(chunk)
+            first = np.searchsorted(times, t0, "left")
+            last = np.searchsorted(times, t1, "right")
+            fft_size = int(record["fft_size"])
+            freq_res = (record["f_end"] - record["f_start"])/fft_size
+            freqs = record["f_start"] + freq_res*np.arange(fft_size)
+            low = np.searchsorted(freqs, f0, "left")
+            high = np.searchsorted(freqs, f1, "right")
+            if first >= last or low >= high:
+                continue
+            segment = dict(self.chunk_meta(chunk))
+            segment.update({
+                "chunk": chunk,
+                "times": times[first:last],
+                "freqs": freqs[low:high],
+                "frames": frames[first:last, low:high],
+            })
+            segments.append(segment)
+        return segments
+
+    def close(self):
+        with self._lock:
+            self.close_chunk()
+            if self._index_file:
+                self._index_file.close()
+                self._index_file = None
+
+
+class PlaybackSource():
+    # Replays recorded frames in blocks of `block` frames. speed 1 keeps the
+    # recorded pace, 0 plays as fast as the consumer reads.
+    store = None
+    t0 = None
+    t1 = None
+    f0 = None
+    f1 = None
+    block = 100
+    speed = 0
+    loop = False
+
+    def __init__(self, store, t0=None, t1=None, f0=None, f1=None, block=100,
+                 speed=0, loop=False):
+        self.store = store
+        self.t0 = t0
+        self.t1 = t1
+        self.f0 = f0
+        self.f1 = f1
+        self.block = block
+        self.speed = speed
+        self.loop = loop
+
+    def __iter__(self):
+        while True:
+            started = None
+            for segment in self.store.query(self.t0, self.t1,
+                                            self.f0, self.f1):
+                for first in range(0, len(segment["frames"]), self.block):
+                    times = segment["times"][first:first+self.block]
+                    if self.speed:
+                        if started is None:
+                            started = (time.monotonic(), times[0])
+                        due = started[0] + \
+                            (times[0] - started[1])/self.speed
+                        delay = due - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    meta = {k: segment[k] for k in META_KEYS}
+                    meta["time"] = times[0]
+                    meta["freqs"] = segment["freqs"]
+                    yield (np.array(segment["frames"][first:first+self.block]),
+                           meta)
+            if not self.loop:
+                return
@@ -1,24 +1,178 @@
 import argparse
+from detection import Detector, METHODS
+from devices import make_device
+from pipeline import POLICIES
+from recorder import PlaybackSource, SpectrogramStore
 from uhd_fft_remote import UhdFftRemote
 
 DEFAULT_BASE_URL = "http://localhost:8000"
 DEFAULT_ROOM_ID = "test"
 
+
+def parse_stage(text):
+    # name=workers[,queue_size[,policy]], e.g. encode=4,2,drop_oldest
+    name, _, config = text.partition("=")
+    values = config.split(",")
+    stage = {"workers": int(values[0])}
+    if len(values) > 1:
+        stage["queue_size"] = int(values[1])
+    if len(values) > 2:
+        if values[2] not in POLICIES:
+            raise argparse.ArgumentTypeError(
+                "Unknown overflow policy %s" % values[2])
+        stage["policy"] = values[2]
+    return name, stage
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='UHD FFT Remote Client')
     parser.add_argument("-b", "--base-url", type=str, default=DEFAULT_BASE_URL,
                         help="Server Base URL")
     parser.add_argument("-r", "--room-id", type=str, default=DEFAULT_ROOM_ID,
                         help="Room ID")
+    parser.add_argument("--fft-backend", type=str, default="numpy",
+                        choices=["numpy", "scipy", "pyfftw"],
+                        help="FFT backend")
+    parser.add_argument("--fft-workers", type=int, default=1,
+                        help="FFT worker threads (scipy/pyfftw)")
+    parser.add_argument("-d", "--device", type=str, default=None,
+                        help="Device: uhd[:args], sim or replay:<file> "
+                        "(default uhd, sim with --playback)")
+    parser.add_argument("--realtime", action="store_true", default=None,
+                        help="Throttle sim/replay devices to the sample rate")
+    parser.add_argument("--no-realtime", action="store_false",
+                        dest="realtime",
+                        help="Run sim/replay devices as fast as possible")
+    parser.add_argument("-c", "--continuous", action="store_true",
+                        help="Keep the streamer running into a ring buffer")
+    parser.add_argument("-e", "--encoding", type=str, default="auto",
+                        choices=["auto", "json", "f32", "f16", "u8"],
+                        help="Result encoding (auto: as requested by server)")
+    parser.add_argument("--render-mode", type=str, default="fast",
+                        choices=["fast", "pretty"],
+                        help="Image renderer (pretty uses matplotlib)")
+    parser.add_argument("--image-format", type=str, default="png",
+                        choices=["png", "webp", "jpeg"],
+                        help="Image format of the fast renderer")
+    parser.add_argument("--stage", type=parse_stage, action="append",
+                        default=[],
+                        help="Stage config name=workers[,queue[,policy]] "
+                        "for the dsp, encode and upload stages")
+    parser.add_argument("--encode-processes", type=int, default=0,
+                        help="Render/encode in a pool of this many processes")
+    parser.add_argument("--params-mode", type=str, default="poll",
+                        choices=["poll", "longpoll", "sse"],
+                        help="How remote params are received")
+    parser.add_argument("--channels", type=str, default=None,
+                        help="Stream these rx channels at once, e.g. 0,1, "
+                        "instead of switching antennas")
+    parser.add_argument("--stats-alpha", type=float, default=None,
+                        help="Keep running spectrum statistics and send them "
+                        "with JSON results (0: plain average, else EMA weight)")
+    parser.add_argument("--output-size", type=str, default=None,
+                        metavar="WIDTHxHEIGHT",
+                        help="Reduce results to at most this many bins x "
+                        "frames before rendering and upload")
+    parser.add_argument("--pooling", type=str, default="max",
+                        choices=["max", "min", "mean"],
+                        help="Pooling used for --output-size")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve /metrics (Prometheus) and /metrics.json "
+                        "on this port")
+    parser.add_argument("--metrics-in-payload", action="store_true",
+                        help="Send a metrics snapshot with JSON results")
+    parser.add_argument("--record", type=str, default=None, metavar="DIR",
+                        help="Append every spectrogram to this store")
+    parser.add_argument("--playback", type=str, default=None, metavar="DIR",
+                        help="Send recorded spectrograms instead of measuring")
+    parser.add_argument("--playback-range", type=float, nargs=2,
+                        default=(None, None), metavar=("START", "END"),
+                        help="Only play back frames between these unix times")
+    parser.add_argument("--playback-speed", type=float, default=1.0,
+                        help="Playback speed, 0 for as fast as possible")
+    parser.add_argument("--data-only", action="store_true",
+                        help="Never render images, only send the data")
+    parser.add_argument("--target-rate", type=float, default=None,
+                        help="Results per second to aim for (default 10)")
+    parser.add_argument("--latency-budget", type=float, default=None,
+                        help="Seconds from capture to upload to aim for "
+                        "(default one period)")
+    parser.add_argument("--no-adapt", action="store_false", dest="adapt",
+                        help="Keep capture length, antenna duty cycle and "
+                        "image rate fixed")
+    parser.add_argument("--events", action="store_true",
+                        help="Send detected events instead of spectrograms, "
+                        "with a full keyframe every --keyframe-interval")
+    parser.add_argument("--keyframe-interval", type=float, default=10.0,
+                        help="Seconds between full results in events mode")
+    parser.add_argument("--detector", type=str, default="floor",
+                        choices=METHODS,
+                        help="Noise estimate of the event detector")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="dB above the noise an event has to be")
+    parser.add_argument("--timed", action="store_true",
+                        help="Capture finite bursts at scheduled device times "
+                        "and time stamp results from the device clock")
+    parser.add_argument("--timed-lead", type=float, default=None,
+                        help="Seconds ahead timed captures are scheduled")
+    parser.add_argument("--no-clock-sync", action="store_false",
+                        dest="sync_clock",
+                        help="Keep the device clock (GPS/PPS) instead of "
+                        "setting it to the host time")
     args = parser.parse_args()
 
+    output_size = (None, None)
+    if args.output_size:
+        width, _, height = args.output_size.partition("x")
+        output_size = (int(height) if height else None, int(width))
+
+    playback = None
+    device = args.device or "uhd"
+    if args.playback:
+        playback = PlaybackSource(SpectrogramStore(args.playback),
+                                  *args.playback_range,
+                                  speed=args.playback_speed)
+        # nothing is captured, so leave the radio alone
+        device = args.device or "sim"
+
     app = None
     try:
         app = UhdFftRemote(args.base_url,
-                           args.room_id)
+                           args.room_id,
+                           fft_backend=args.fft_backend,
+                           fft_workers=args.fft_workers,
+                           continuous=args.continuous,
+                           device=make_device(device, args.realtime),
+                           encoding=args.encoding,
+                           render_mode=args.render_mode,
+                           image_format=args.image_format,
+                           stage_config=dict(args.stage),
+                           encode_processes=args.encode_processes,
+                           params_mode=args.params_mode,
+                           channels=[int(c) for c in args.channels.split(",")]
+                           if args.channels else None,
+                           stats_alpha=args.stats_alpha,
+                           output_size=output_size,
+                           pooling=args.pooling,
+                           metrics_port=args.metrics_port,
+                           metrics_in_payload=args.metrics_in_payload,
+                           store=SpectrogramStore(args.record, writable=True)
+                           if args.record else None,
+                           playback=playback,
+                           data_only=args.data_only,
+                           target_rate=args.target_rate,
+                           latency_budget=args.latency_budget,
+                           adapt=args.adapt,
+                           detector=Detector(args.detector, args.threshold)
+                           if args.events else None,
+                           keyframe_interval=args.keyframe_interval,
+                           timed=args.timed,
+                           timed_lead=args.timed_lead,
+                           sync_clock=args.sync_clock)
         app.measurement_worker()
     except KeyboardInterrupt:
         print("Exiting...")
     finally:
         if app:
             app.running = False
+            app.uhd_fft.stop_continuous()
@@ -0,0 +1,128 @@
+import io
+import struct
+import zlib
+import numpy as np
+
+# inferno sampled at 17 evenly spaced points, interpolated to the full LUT
+INFERNO = np.array([
+    [0, 0, 4], [11, 7, 36], [33, 12, 74], [61, 9, 101], [87, 16, 110],
+    [113, 25, 110], [138, 34, 106], [163, 44, 97], [188, 55, 84],
+    [210, 70, 68], [228, 90, 49], [241, 115, 29], [249, 142, 9],
+    [252, 172, 17], [249, 203, 53], [242, 234, 105], [252, 255, 164],
+], dtype=np.float32)
+
+
+def colormap_lut(points=INFERNO, size=256):
+    xs = np.linspace(0, 1, len(points))
+    x = np.linspace(0, 1, size)
+    lut = np.stack([np.interp(x, xs, points[:, i]) for i in range(3)], 1)
+    return np.round(lut).astype(np.uint8)
+
+
+def png_chunk(tag, data):
+    chunk = tag + data
+    return struct.pack(">I", len(data)) + chunk + \
+        struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+
+def encode_png(rgb, level=1):
+    height, width, _ = rgb.shape
+    # every scanline is prefixed with filter type 0 (none)
+    raw = np.zeros((height, width*3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, width*3)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join((b"\x89PNG\r\n\x1a\n",
+                     png_chunk(b"IHDR", header),
+                     png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+                     png_chunk(b"IEND", b"")))
+
+
+def encode_image(rgb, image_format="png", quality=80):
+    try:
+        from PIL import Image
+    except ImportError:
+        if image_format != "png":
+            raise
+        return encode_png(rgb)
+    bts = io.BytesIO()
+    if image_format == "png":
+        Image.fromarray(rgb).save(bts, format="png", compress_level=1)
+    else:
+        Image.fromarray(rgb).save(bts, format=image_format, quality=quality)
+    return bts.getvalue()
+
+
+class SpectrogramRenderer():
+    vmin = -45
+    vmax = 0
+    width = None
+    waterfall_height = 240
+    trace_height = 120
+    image_format = "png"
+    quality = 80
+    trace_colors = ((0, 200, 0), (220, 0, 0), (0, 120, 255))
+    grid_color = (48, 48, 48)
+    _lut = None
+
+    def __init__(self, vmin=-45, vmax=0, width=None, waterfall_height=240,
+                 trace_height=120, image_format="png"):
+        self.vmin = vmin
+        self.vmax = vmax
+        self.width = width
+        self.waterfall_height = waterfall_height
+        self.trace_height = trace_height
+        self.image_format = image_format
+        self._lut = colormap_lut()
+
+    @staticmethod
+    def sample_index(n_in, n_out):
+        return (np.arange(n_out)*n_in) // n_out
+
+    def colorize(self, freq_result, height, width):
+        rows = self.sample_index(freq_result.shape[0], height)
+        cols = self.sample_index(freq_result.shape[1], width)
+        levels = freq_result[rows[:, None], cols]
+        levels -= self.vmin
+        levels *= 255/(self.vmax - self.vmin)
+        np.clip(levels, 0, 255, out=levels)
+        return self._lut[levels.astype(np.uint8)]
+
+    def trace_rows(self, avg_power, width):
+        # pixel row of the trace at every column, 0 at the top (vmax)
+        cols = self.sample_index(len(avg_power), width)
+        y = (self.vmax - avg_power[cols])/(self.vmax - self.vmin)
+        np.clip(y, 0, 1, out=y)
+        return np.round(y*(self.trace_height - 1)).astype(np.int32)
+
+    def draw_trace(self, panel, avg_power, color):
+        height, width, _ = panel.shape
+        y = self.trace_rows(avg_power, width)
+        # connect neighbouring points with vertical runs so the line is
+        # continuous, then paint all runs with a single mask
+        y_next = np.append(y[1:], y[-1])
+        lo = np.minimum(y, y_next)
+        hi = np.maximum(y, y_next)
+        rows = np.arange(height)[:, None]
+        panel[(rows >= lo) & (rows <= hi)] = color
+
+    def draw_grid(self, panel, n_lines=4):
+        height = panel.shape[0]
+        for i in range(1, n_lines):
+            panel[i*height // n_lines] = self.grid_color
+
+    def render_rgb(self, freq_result, *traces):
+        width = self.width or freq_result.shape[1]
+        image = np.zeros((self.waterfall_height + self.trace_height, width, 3),
+                         dtype=np.uint8)
+        image[:self.waterfall_height] = self.colorize(
+            freq_result, self.waterfall_height, width)
+
+        panel = image[self.waterfall_height:]
+        self.draw_grid(panel)
+        for trace, color in zip(traces, self.trace_colors):
+            self.draw_trace(panel, np.mean(trace, axis=0), color)
+        return image
+
+    def render(self, freq_result, *traces):
+        return encode_image(self.render_rgb(freq_result, *traces),
+                            self.image_format, self.quality)
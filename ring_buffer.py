@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+
+
+class RingBuffer():
+    # Single producer ring buffer. The producer writes into a view of the
+    # storage and then publishes it by bumping the monotonic `written`
+    # counter; readers copy out by absolute sample position and check
+    # afterwards that the producer has not lapped them. No lock is held
+    # while samples are written or read, the condition is only used to
+    # wake up waiting readers.
+    _data = None
+    _size = 0
+    _channels = 1
+    _max_write = 0
+    _written = 0
+    _valid_from = 0
+    _lost = 0
+    _cond = None
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def written(self):
+        return self._written
+
+    @property
+    def valid_from(self):
+        return self._valid_from
+
+    @property
+    def lost(self):
+        return self._lost
+
+    def __init__(self, size, channels=1, max_write=None, dtype=np.complex64):
+        self._size = int(size)
+        self._channels = int(channels)
+        self._max_write = int(max_write or self._size // 8)
+        if self._max_write >= self._size:
+            raise ValueError("Ring buffer of %d samples is too small for "
+                             "writes of %d samples" %
+                             (self._size, self._max_write))
+        self._data = np.zeros((self._channels, self._size), dtype=dtype)
+        self._written = 0
+        self._valid_from = 0
+        self._lost = 0
+        self._cond = threading.Condition()
+
+    def write_view(self):
+        start = self._written % self._size
+        end = min(self._size, start + self._max_write)
+        return self._data[:, start:end]
+
+    def commit(self, n_samples):
+        self._written += int(n_samples)
+        with self._cond:
+            self._cond.notify_all()
+
+    def write(self, samples):
+        samples = np.atleast_2d(samples)
+        offset = 0
+        while offset < samples.shape[1]:
+            view = self.write_view()
+            n = min(view.shape[1], samples.shape[1] - offset)
+            view[:, :n] = samples[:, offset:offset+n]
+            self.commit(n)
+            offset += n
+
+    def reset(self, position=None):
+        # samples written so far, or all before `position` (which may be
+        # ahead of the writer), are stale, e.g. taken before a retune
+        self._valid_from = max(self._valid_from, self._written
+                               if position is None else int(position))
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait_for(self, position, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._written >= position,
+                                       timeout)
+
+    def oldest(self):
+        return max(self._valid_from,
+                   self._written + self._max_write - self._size)
+
+    def copy(self, start, n_samples, out):
+        idx = start % self._size
+        first = min(n_samples, self._size - idx)
+        out[:, :first] = self._data[:, idx:idx+first]
+        out[:, first:n_samples] = self._data[:, :n_samples-first]
+        # the producer may have lapped us while copying
+        return start >= self.oldest()
+
+    def latest(self, n_samples, since=0, out=None, timeout=None):
+        if n_samples > self._size - self._max_write:
+            raise ValueError("Cannot read %d samples from a ring of %d" %
+                             (n_samples, self._size))
+        if out is None:
+            out = np.empty((self._channels, n_samples), dtype=self._data.dtype)
+        while True:
+            ready = max(since, self._valid_from) + n_samples
+            if not self.wait_for(ready, timeout):
+                return None, since
+            end = self._written
+            if self.copy(end - n_samples, n_samples, out):
+                return out, end
+
+    def frames(self, n_samples, start=None, timeout=None):
+        # gapless iteration; the yielded array is reused for the next block
+        position = self._written if start is None else start
+        out = np.empty((self._channels, n_samples), dtype=self._data.dtype)
+        while True:
+            if position < self.oldest():
+                self._lost += self.oldest() - position
+                position = self.oldest()
+            if not self.wait_for(position + n_samples, timeout):
+                return
+            if not self.copy(position, n_samples, out):
+                continue
+            position += n_samples
+            yield out
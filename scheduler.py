@@ -0,0 +1,159 @@
+import time
+
+
+class AdaptiveScheduler():
+    # Paces acquisitions on a fixed deadline grid of 1/target_rate instead
+    # of sleeping after the work, and keeps the work per frame within the
+    # period (throughput, stages run concurrently) and within the latency
+    # budget (the sum of all stages). Stage costs come from the timings in
+    # Metrics; every `adapt_every` frames the cheapest knob that fixes an
+    # overrun is turned: render images less often when rendering dominates,
+    # capture the second antenna less often when switching dominates, and
+    # finally shorten the capture. Knobs are turned back in reverse order
+    # once there is plenty of headroom. Frames are skipped instead of
+    # queued while the encode/upload queues still hold earlier ones.
+    target_rate = 10.
+    latency_budget = None
+    adapt = True
+    adapt_every = 5
+    alpha = 0.3
+    min_n_samples = None
+    max_n_samples = None
+    max_antenna_every = 8
+    max_image_every = 8
+    n_samples = None
+    antenna_every = 1
+    image_every = 1
+    switching = False
+    costs = None
+    metrics = None
+    _deadline = None
+    _totals = None
+    _frames = 0
+
+    def __init__(self, metrics, n_samples, target_rate=10.,
+                 latency_budget=None, adapt=True, min_n_samples=None,
+                 max_antenna_every=8, max_image_every=8):
+        self.metrics = metrics
+        self.target_rate = target_rate
+        self.latency_budget = latency_budget
+        self.adapt = adapt
+        self.n_samples = n_samples
+        self.max_n_samples = n_samples
+        self.min_n_samples = min_n_samples or max(1, n_samples//64)
+        self.max_antenna_every = max_antenna_every
+        self.max_image_every = max_image_every
+        self.costs = {}
+        self._totals = metrics.totals()
+
+    @property
+    def period(self):
+        return 1/self.target_rate
+
+    @property
+    def budget(self):
+        return self.latency_budget or self.period
+
+    def wait(self):
+        # sleep until the next slot; when more than a period late, start a
+        # new grid from now rather than bursting to catch up
+        now = time.monotonic()
+        if self._deadline is None or now - self._deadline > self.period:
+            self._deadline = now
+        delay = self._deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        self._deadline += self.period
+        return -delay
+
+    def should_skip(self, queue_depths):
+        return any(queue_depths.get(stage) for stage in ("encode", "upload"))
+
+    def measure(self):
+        # mean cost per frame of every stage since the last call, smoothed
+        totals = self.metrics.totals()
+        frames = self._frames
+        self._frames = 0
+        if not frames:
+            return self.costs
+        for name, (count, total) in totals.items():
+            prev_count, prev_total = self._totals.get(name, (0, 0.))
+            if count == prev_count:
+                continue
+            cost = (total - prev_total)/frames
+            prev = self.costs.get(name)
+            self.costs[name] = cost if prev is None else \
+                prev + self.alpha*(cost - prev)
+        self._totals = totals
+        return self.costs
+
+    def stage_costs(self):
+        costs = self.costs
+        return {
+            "acquire": costs.get("tune", 0.) + costs.get("recv", 0.),
+            "dsp": costs.get("psd", 0.) + costs.get("detect", 0.),
+            "image": costs.get("render", 0.),
+            "encode": costs.get("encode", 0.),
+            "upload": costs.get("upload", 0.),
+        }
+
+    def load(self, stages):
+        # > 1 means frames cannot keep up with the period or the budget
+        encode = stages["image"] + stages["encode"]
+        bottleneck = max(stages["acquire"], stages["dsp"], encode,
+                         stages["upload"])
+        return max(bottleneck/self.period, sum(stages.values())/self.budget)
+
+    def frame_done(self, switching=False):
+        # returns True when one of the knobs changed
+        self._frames += 1
+        self.switching = switching
+        if not self.adapt or self._frames < self.adapt_every:
+            return False
+        self.measure()
+        stages = self.stage_costs()
+        load = self.load(stages)
+        changed = False
+        if load > 1.1:
+            changed = self.speed_up(stages)
+        elif load < 0.5:
+            changed = self.slow_down()
+        if changed:
+            # costs measured with the old settings no longer apply
+            self.costs = {}
+        return changed
+
+    def speed_up(self, stages):
+        heaviest = max(stages, key=stages.get)
+        if heaviest in ("image", "encode", "upload") and \
+                self.image_every < self.max_image_every:
+            self.image_every *= 2
+        elif heaviest == "acquire" and self.switching and \
+                self.antenna_every < self.max_antenna_every:
+            self.antenna_every *= 2
+        elif self.n_samples > self.min_n_samples:
+            self.n_samples = max(self.min_n_samples, self.n_samples//2)
+        elif self.image_every < self.max_image_every:
+            self.image_every *= 2
+        else:
+            return False
+        return True
+
+    def slow_down(self):
+        if self.n_samples < self.max_n_samples:
+            self.n_samples = min(self.max_n_samples, self.n_samples*2)
+        elif self.antenna_every > 1:
+            self.antenna_every //= 2
+        elif self.image_every > 1:
+            self.image_every //= 2
+        else:
+            return False
+        return True
+
+    def state(self):
+        return {
+            "target_rate": self.target_rate,
+            "n_samples": self.n_samples,
+            "antenna_every": self.antenna_every,
+            "image_every": self.image_every,
+        }
@@ -0,0 +1,589 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import urllib.parse
+import numpy as np
+
+import wire_format
+from metrics import Metrics, PROMETHEUS_CONTENT_TYPE
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xa
+
+REASONS = {
+    101: "Switching Protocols",
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+}
+
+
+class HttpError(Exception):
+    status = 400
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or REASONS.get(status, ""))
+        self.status = status
+
+
+def ws_header(opcode, length):
+    # header of an unmasked, unfragmented server frame
+    if length < 126:
+        return struct.pack("!BB", 0x80 | opcode, length)
+    if length < 1 << 16:
+        return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+
+async def read_ws_frame(reader, max_size=1 << 20):
+    # one (opcode, payload) from a client, fragments are not reassembled
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    if length > max_size:
+        raise ConnectionError("WebSocket frame of %d bytes" % length)
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask and length:
+        payload = (np.frombuffer(payload, dtype=np.uint8) ^
+                   np.resize(np.frombuffer(mask, dtype=np.uint8),
+                             length)).tobytes()
+    return first & 0x0f, payload
+
+
+class Request():
+    method = "GET"
+    path = "/"
+    query = None
+    headers = None
+    body = b""
+    keep_alive = True
+
+    def __init__(self, method, target, version, headers, body=b""):
+        url = urllib.parse.urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = {k: v[0] for k, v in
+                      urllib.parse.parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+        connection = headers.get("connection", "").lower()
+        self.keep_alive = connection != "close" if version == "HTTP/1.1" \
+            else connection == "keep-alive"
+
+
+class Message():
+    # One published result, events or params update of a room. The body is
+    # shared by every viewer and the SSE and WebSocket framings are made
+    # once, by the first viewer that needs them, never per viewer.
+    kind = "result"
+    seq = 0
+    count = 0
+    body = b""
+    content_type = "application/json"
+    _sse = None
+    _ws = None
+
+    def __init__(self, kind, seq, count, body, content_type):
+        self.kind = kind
+        self.seq = seq
+        self.count = count
+        self.body = body
+        self.content_type = content_type
+
+    @property
+    def binary(self):
+        return "json" not in self.content_type
+
+    def sse_frame(self):
+        if self._sse is None:
+            data = self.body
+            if self.binary:
+                data = json.dumps({
+                    "content_type": self.content_type,
+                    "data": base64.b64encode(self.body).decode("ascii"),
+                }).encode()
+            self._sse = b"".join((b"event: ", self.kind.encode(),
+                                  b"\nid: %d\ndata: " % self.seq, data,
+                                  b"\n\n"))
+        return self._sse
+
+    def ws_frame(self):
+        # header and body apart so the body is written without a copy
+        if self._ws is None:
+            opcode = WS_BINARY if self.binary else WS_TEXT
+            self._ws = (ws_header(opcode, len(self.body)), self.body)
+        return self._ws
+
+
+class Room():
+    # Params and the latest message of every kind. Viewers are not queued
+    # to: they wait for a change and then send whatever is newest, so a
+    # slow viewer skips results instead of piling them up.
+    name = ""
+    params = None
+    version = 0
+    latest = None
+    viewers = 0
+    _seq = 0
+    _counts = None
+    _changed = None
+
+    def __init__(self, name):
+        self.name = name
+        self.params = {}
+        self.latest = {}
+        self._counts = {}
+        self._changed = asyncio.Event()
+
+    @property
+    def etag(self):
+        return '"%d"' % self.version
+
+    def publish(self, kind, body, content_type):
+        self._seq += 1
+        self._counts[kind] = self._counts.get(kind, 0) + 1
+        message = Message(kind, self._seq, self._counts[kind], body,
+                          content_type)
+        self.latest[kind] = message
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+        return message
+
+    def update_params(self, params):
+        # {name: {"raw": value}} as the sensors read them, bare values are
+        # wrapped
+        for k, v in params.items():
+            if not isinstance(v, dict) or "raw" not in v:
+                v = {"raw": v}
+            self.params[k] = v
+        self.version += 1
+        self.publish("params", json.dumps(self.params).encode(),
+                     "application/json")
+
+    async def wait(self, timeout=None):
+        # False when nothing was published within the timeout
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def newer(self, sent):
+        # latest message of every kind past sent[kind], oldest first
+        return sorted((m for m in self.latest.values()
+                       if m.seq > sent.get(m.kind, 0)),
+                      key=lambda m: m.seq)
+
+
+class Server():
+    # Reference server of the room protocol on plain asyncio streams:
+    #   POST /create_room, GET|POST /params (ETag, ?wait= long polling),
+    #   GET /params/stream (SSE), POST|GET /result, GET /events,
+    #   GET /viewer/stream (SSE) and /viewer/ws (WebSocket), GET /rooms,
+    #   GET /metrics.
+    # Rooms are created on first use. Results are kept in memory, only the
+    # latest of each kind per room.
+    host = "0.0.0.0"
+    port = 8000
+    heartbeat = 15.0
+    send_timeout = 30.0
+    max_body = 64 << 20
+    rooms = None
+    routes = None
+    metrics = None
+    _server = None
+
+    def __init__(self, host="0.0.0.0", port=8000, heartbeat=15.0,
+                 send_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat
+        self.send_timeout = send_timeout
+        self.rooms = {}
+        self.metrics = Metrics(prefix="uhd_fft_server")
+        self.metrics.gauge("rooms", lambda: len(self.rooms))
+        self.metrics.gauge("viewers", lambda: {
+            name: room.viewers for name, room in self.rooms.items()},
+            label="room")
+        self.routes = {
+            ("POST", "/create_room"): self.create_room,
+            ("GET", "/params"): self.get_params,
+            ("POST", "/params"): self.post_params,
+            ("GET", "/params/stream"): self.params_stream,
+            ("POST", "/result"): self.post_result,
+            ("GET", "/result"): self.get_latest,
+            ("GET", "/events"): self.get_latest,
+            ("GET", "/viewer/stream"): self.viewer_stream,
+            ("GET", "/viewer/ws"): self.viewer_ws,
+            ("GET", "/rooms"): self.get_rooms,
+            ("GET", "/metrics"): self.get_metrics,
+        }
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host,
+                                                  self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    def get_room(self, request, create=True):
+        name = request.query.get("room")
+        if not name:
+            raise HttpError(400, "room is required")
+        room = self.rooms.get(name)
+        if room is None:
+            if not create:
+                raise HttpError(404, "No room %s" % name)
+            room = self.rooms[name] = Room(name)
+        return room
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                route = self.routes.get((request.method, request.path))
+                if route is None:
+                    known = any(path == request.path
+                                for _, path in self.routes)
+                    raise HttpError(405 if known else 404)
+                if not await route(request, reader, writer) or \
+                        not request.keep_alive:
+                    break
+        except HttpError as err:
+            self.metrics.inc("http_errors")
+            try:
+                await self.respond(writer, err.status, str(err).encode(),
+                                   "text/plain", close=True)
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as err:
+            if err.partial.strip():
+                raise HttpError(400)
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(431)
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400)
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        if "chunked" in headers.get("transfer-encoding", ""):
+            raise HttpError(411)
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HttpError(400, "Bad Content-Length")
+        if length < 0:
+            raise HttpError(400, "Bad Content-Length")
+        if length > self.max_body:
+            raise HttpError(413)
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, target, version, headers, body)
+
+    async def respond(self, writer, status, body=b"", content_type=None,
+                      headers=None, close=False):
+        lines = ["HTTP/1.1 %d %s" % (status, REASONS.get(status, "")),
+                 "Content-Length: %d" % len(body)]
+        if content_type:
+            lines.append("Content-Type: %s" % content_type)
+        for k, v in (headers or {}).items():
+            lines.append("%s: %s" % (k, v))
+        if close:
+            lines.append("Connection: close")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        writer.writelines((head, body))
+        await self.drain(writer)
+
+    async def drain(self, writer):
+        # a viewer that does not take its data within send_timeout is
+        # dropped rather than holding up anything else
+        try:
+            await asyncio.wait_for(writer.drain(), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.inc("viewers_dropped")
+            raise
+
+    async def create_room(self, request, reader, writer):
+        self.get_room(request)
+        await self.respond(writer, 200)
+        return True
+
+    async def get_params(self, request, reader, writer):
+        room = self.get_room(request)
+        try:
+            wait = float(request.query.get("wait", 0))
+        except ValueError:
+            raise HttpError(400, "wait must be a number of seconds")
+        if request.headers.get("if-none-match") == room.etag and wait > 0:
+            # long poll: hold the request until the params change
+            deadline = asyncio.get_running_loop().time() + wait
+            while room.etag == request.headers["if-none-match"]:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0 or not await room.wait(remaining):
+                    break
+        headers = {"ETag": room.etag}
+        if request.headers.get("if-none-match") == room.etag:
+            await self.respond(writer, 304, headers=headers)
+        else:
+            await self.respond(writer, 200, json.dumps(room.params).encode(),
+                               "application/json", headers)
+        return True
+
+    async def post_params(self, request, reader, writer):
+        room = self.get_room(request)
+        try:
+            params = json.loads(request.body or b"{}")
+        except ValueError:
+            raise HttpError(400, "params must be a JSON object")
+        if not isinstance(params, dict):
+            raise HttpError(400, "params must be a JSON object")
+        room.update_params(params)
+        await self.respond(writer, 200, headers={"ETag": room.etag})
+        return True
+
+    async def post_result(self, request, reader, writer):
+        room = self.get_room(request)
+        content_type = request.headers.get("content-type",
+                                           "application/json")
+        kind = "events" \
+            if content_type.startswith(wire_format.EVENTS_CONTENT_TYPE) \
+            else "result"
+        room.publish(kind, request.body, content_type)
+        self.metrics.inc(kind)
+        self.metrics.inc(kind + "_bytes", len(request.body))
+        await self.respond(writer, 200)
+        return True
+
+    async def get_latest(self, request, reader, writer):
+        room = self.get_room(request, create=False)
+        message = room.latest.get(request.path.strip("/"))
+        if message is None:
+            raise HttpError(404, "Nothing published yet")
+        headers = {"ETag": '"%d"' % message.seq}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            await self.respond(writer, 304, headers=headers)
+        else:
+            await self.respond(writer, 200, message.body,
+                               message.content_type, headers)
+        return True
+
+    async def get_rooms(self, request, reader, writer):
+        rooms = {name: {
+            "viewers": room.viewers,
+            "params_version": room.version,
+            "latest": {kind: {"seq": m.seq, "count": m.count,
+                              "bytes": len(m.body),
+                              "content_type": m.content_type}
+                       for kind, m in room.latest.items()},
+        } for name, room in self.rooms.items()}
+        await self.respond(writer, 200, json.dumps(rooms).encode(),
+                           "application/json")
+        return True
+
+    async def get_metrics(self, request, reader, writer):
+        await self.respond(writer, 200, self.metrics.prometheus().encode(),
+                           PROMETHEUS_CONTENT_TYPE)
+        return True
+
+    async def start_stream(self, writer):
+        # chunked, one event per chunk, so clients that read the body in
+        # blocks still see every event as it arrives
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n"
+                     b"Transfer-Encoding: chunked\r\n"
+                     b"Connection: close\r\n\r\n")
+        await self.drain(writer)
+
+    async def send_event(self, writer, event):
+        writer.writelines((b"%x\r\n" % len(event), event, b"\r\n"))
+        await self.drain(writer)
+
+    async def first_of(self, *coros):
+        # run until one of them ends, a client going away is no error
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # collect what the cancelled ones raised on their way out
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            err = None if task.cancelled() else task.exception()
+            if err and not isinstance(err, (ConnectionError,
+                                            asyncio.IncompleteReadError,
+                                            asyncio.TimeoutError)):
+                raise err
+        return False
+
+    async def until_closed(self, reader, producer):
+        async def wait_eof():
+            while await reader.read(4096):
+                pass
+
+        return await self.first_of(producer, wait_eof())
+
+    async def params_stream(self, request, reader, writer):
+        room = self.get_room(request)
+        await self.start_stream(writer)
+
+        async def produce():
+            sent = request.headers.get("last-event-id")
+            while True:
+                if room.etag != sent:
+                    sent = room.etag
+                    await self.send_event(writer, b"id: %s\ndata: %s\n\n" % (
+                        sent.encode(), json.dumps(room.params).encode()))
+                elif not await room.wait(self.heartbeat):
+                    await self.send_event(writer, b": ping\n\n")
+
+        return await self.until_closed(reader, produce())
+
+    async def feed(self, room, send, ping):
+        # the viewer's own loop: send what is newer than what it got last,
+        # skipping everything published while it was still sending
+        sent = {}
+        counts = {}
+        while True:
+            messages = room.newer(sent)
+            if not messages:
+                if not await room.wait(self.heartbeat):
+                    await ping()
+                continue
+            for message in messages:
+                skipped = message.count - counts.get(message.kind,
+                                                     message.count - 1) - 1
+                if skipped:
+                    self.metrics.inc("viewer_skipped", skipped)
+                await send(message)
+                self.metrics.inc("viewer_messages")
+                sent[message.kind] = message.seq
+                counts[message.kind] = message.count
+
+    async def viewer_stream(self, request, reader, writer):
+        room = self.get_room(request)
+        await self.start_stream(writer)
+
+        async def send(message):
+            await self.send_event(writer, message.sse_frame())
+
+        async def ping():
+            await self.send_event(writer, b": ping\n\n")
+
+        room.viewers += 1
+        try:
+            return await self.until_closed(reader,
+                                           self.feed(room, send, ping))
+        finally:
+            room.viewers -= 1
+
+    async def viewer_ws(self, request, reader, writer):
+        room = self.get_room(request)
+        key = request.headers.get("sec-websocket-key")
+        if not key or "websocket" not in \
+                request.headers.get("upgrade", "").lower():
+            raise HttpError(400, "WebSocket upgrade expected")
+        accept = base64.b64encode(
+            hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+        await self.drain(writer)
+
+        async def send(message):
+            writer.writelines(message.ws_frame())
+            await self.drain(writer)
+
+        async def ping():
+            writer.write(ws_header(WS_PING, 0))
+            await self.drain(writer)
+
+        async def receive():
+            # pings, close and JSON params from the viewer
+            while True:
+                opcode, payload = await read_ws_frame(reader)
+                if opcode == WS_CLOSE:
+                    writer.write(ws_header(WS_CLOSE, 0))
+                    return
+                if opcode == WS_PING:
+                    writer.writelines((ws_header(WS_PONG, len(payload)),
+                                       payload))
+                elif opcode == WS_TEXT:
+                    try:
+                        params = json.loads(payload)
+                    except ValueError:
+                        continue
+                    if isinstance(params, dict):
+                        room.update_params(params)
+
+        room.viewers += 1
+        try:
+            return await self.first_of(self.feed(room, send, ping),
+                                       receive())
+        finally:
+            room.viewers -= 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='UHD FFT reference server')
+    parser.add_argument("--host", type=str, default="0.0.0.0",
+                        help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8000,
+                        help="Port to listen on")
+    parser.add_argument("--heartbeat", type=float, default=15.0,
+                        help="Seconds between keep-alive pings of idle "
+                        "streams")
+    parser.add_argument("--send-timeout", type=float, default=30.0,
+                        help="Drop viewers that take longer than this to "
+                        "accept a message")
+    args = parser.parse_args()
+
+    server = Server(args.host, args.port, args.heartbeat, args.send_timeout)
+    print("Listening on %s:%d" % (args.host, args.port))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("Exiting...")
@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+
+
+class SpectrumStats():
+    # Incremental per-bin statistics over a stream of spectrogram frames.
+    # Every update is O(bins) per frame: running or exponential average,
+    # max/min hold and a fixed-step dB histogram per bin from which
+    # percentiles and occupancy are read without keeping the frames.
+    n_bins = 0
+    alpha = None
+    hist_range = (-160.0, 20.0)
+    hist_step = 1.0
+    count = 0
+    _sum = None
+    _avg = None
+    _max = None
+    _min = None
+    _hist = None
+    _lock = None
+
+    def __init__(self, n_bins, alpha=None, hist_range=(-160.0, 20.0),
+                 hist_step=1.0):
+        self.alpha = alpha
+        self.hist_range = hist_range
+        self.hist_step = hist_step
+        self._lock = threading.RLock()
+        self.reset(n_bins)
+
+    @property
+    def n_hist(self):
+        lo, hi = self.hist_range
+        return int(np.ceil((hi - lo)/self.hist_step))
+
+    def reset(self, n_bins=None):
+        with self._lock:
+            if n_bins is not None:
+                self.n_bins = int(n_bins)
+            self.count = 0
+            self._sum = np.zeros(self.n_bins, dtype=np.float64)
+            self._avg = np.zeros(self.n_bins, dtype=np.float64)
+            self._max = np.full(self.n_bins, -np.inf, dtype=np.float32)
+            self._min = np.full(self.n_bins, np.inf, dtype=np.float32)
+            self._hist = np.zeros((self.n_bins, self.n_hist), dtype=np.int64)
+
+    def update(self, freq_result):
+        # several pipeline workers may update at once, one at a time
+        frames = np.atleast_2d(freq_result)
+        n_frames = len(frames)
+
+        with self._lock:
+            if frames.shape[1] != self.n_bins:
+                self.reset(frames.shape[1])
+            self._sum += frames.sum(axis=0, dtype=np.float64)
+            if self.alpha is not None:
+                # n sequential EMA steps folded into one weighted sum
+                ema_frames = frames
+                if self.count == 0:
+                    self._avg[:] = frames[0]
+                    ema_frames = frames[1:]
+                decay = 1 - self.alpha
+                n = len(ema_frames)
+                weights = self.alpha*decay**np.arange(n - 1, -1, -1)
+                self._avg *= decay**n
+                self._avg += weights @ ema_frames
+            np.maximum(self._max, frames.max(axis=0), out=self._max)
+            np.minimum(self._min, frames.min(axis=0), out=self._min)
+
+            lo = self.hist_range[0]
+            idx = ((frames - lo)/self.hist_step).astype(np.int64)
+            np.clip(idx, 0, self.n_hist - 1, out=idx)
+            idx += np.arange(self.n_bins)*self.n_hist
+            self._hist += np.bincount(
+                idx.ravel(), minlength=self.n_bins*self.n_hist
+            ).reshape(self.n_bins, self.n_hist)
+            self.count += n_frames
+
+    @property
+    def average(self):
+        if self.alpha is not None:
+            return self._avg.astype(np.float32)
+        return (self._sum/max(1, self.count)).astype(np.float32)
+
+    @property
+    def max_hold(self):
+        return self._max.copy()
+
+    @property
+    def min_hold(self):
+        return self._min.copy()
+
+    def percentile(self, q):
+        target = q/100*self.count
+        below = np.cumsum(self._hist, axis=1) < target
+        idx = below.sum(axis=1)
+        return (self.hist_range[0] +
+                (idx + .5)*self.hist_step).astype(np.float32)
+
+    def occupancy(self, threshold):
+        # fraction of frames per bin at or above threshold dB
+        lo = self.hist_range[0]
+        first = int(np.clip((threshold - lo)//self.hist_step,
+                            0, self.n_hist))
+        return (self._hist[:, first:].sum(axis=1) /
+                max(1, self.count)).astype(np.float32)
+
+    def traces(self, percentiles=(95,)):
+        # consistent with each other, not torn by a concurrent update
+        with self._lock:
+            traces = {
+                "count": self.count,
+                "average": self.average,
+                "max_hold": self.max_hold,
+                "min_hold": self.min_hold,
+            }
+            for q in percentiles:
+                traces["p%g" % q] = self.percentile(q)
+        return traces
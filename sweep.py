@@ -0,0 +1,110 @@
+import time
+import numpy as np
+
+
+class SweepEngine():
+    # Covers [start_freq, stop_freq] with overlapping retune hops and
+    # stitches the per-hop spectrograms onto one frequency grid. Edge bins
+    # (filter roll-off) and the bins around DC (LO leakage) are dropped
+    # from every hop; the overlap between hops fills them back in.
+    # Successive sweeps alternate direction so every sweep starts where
+    # the previous one ended, and hops only wait settle_time for the LO
+    # when the RF LO actually moved.
+    start_freq = None
+    stop_freq = None
+    overlap = 0.25
+    edge_fraction = 0.1
+    dc_bins = 2
+    settle_time = 1e-3
+    uhd_fft = None
+    _direction = 1
+
+    def __init__(self, uhd_fft, start_freq, stop_freq, overlap=0.25,
+                 edge_fraction=0.1, dc_bins=2, settle_time=1e-3):
+        if stop_freq <= start_freq:
+            raise ValueError("Sweep stop frequency must be above the start")
+        self.uhd_fft = uhd_fft
+        self.start_freq = float(start_freq)
+        self.stop_freq = float(stop_freq)
+        self.overlap = overlap
+        self.edge_fraction = edge_fraction
+        self.dc_bins = dc_bins
+        self.settle_time = settle_time
+
+    @property
+    def usable_bandwidth(self):
+        return self.uhd_fft.bandwidth*(1 - 2*self.edge_fraction)
+
+    def plan(self):
+        usable = self.usable_bandwidth
+        step = usable*(1 - self.overlap)
+        n_hops = max(1, int(np.ceil(
+            (self.stop_freq - self.start_freq - usable)/step)) + 1)
+        hops = self.start_freq + usable/2 + step*np.arange(n_hops)
+        return hops if self._direction > 0 else hops[::-1]
+
+    def keep_mask(self, fft_size):
+        keep = np.ones(fft_size, dtype=bool)
+        edge = int(fft_size*self.edge_fraction)
+        keep[:edge] = False
+        keep[fft_size - edge:] = False
+        keep[max(0, fft_size//2 - self.dc_bins):
+             fft_size//2 + self.dc_bins + 1] = False
+        return keep
+
+    def capture_hop(self, center_freq, prev_rf_freq):
+        # the spectrogram comes from the buffer pool, see UhdFft.release()
+        self.uhd_fft.center_freq = center_freq
+        tune_result = self.uhd_fft.tune_result()
+        rf_freq = getattr(tune_result, "actual_rf_freq", None)
+        if rf_freq != prev_rf_freq and self.settle_time:
+            self.uhd_fft.settle(self.settle_time)
+        return self.uhd_fft.usrp_recv(), rf_freq
+
+    def sweep(self):
+        started = time.monotonic()
+        fft_size = self.uhd_fft.fft_size
+        freq_res = self.uhd_fft.freq_res
+        bandwidth = self.uhd_fft.bandwidth
+        n_bins = int(np.ceil((self.stop_freq - self.start_freq)/freq_res))
+        keep = self.keep_mask(fft_size)
+        bins = np.flatnonzero(keep)
+
+        hops = self.plan()
+        total = None
+        count = np.zeros(n_bins, dtype=np.int32)
+        rf_freq = None
+        for center_freq in hops:
+            freq_result, rf_freq = self.capture_hop(center_freq, rf_freq)
+            # stitched right away, so one pooled buffer serves every hop
+            if total is None:
+                total = np.zeros((len(freq_result), n_bins),
+                                 dtype=np.float64)
+            first = int(round((center_freq - bandwidth/2 - self.start_freq) /
+                              freq_res))
+            idx = first + bins
+            valid = (idx >= 0) & (idx < n_bins)
+            # indices are unique within a hop, so plain fancy += is safe
+            total[:, idx[valid]] += freq_result[:, bins[valid]]
+            count[idx[valid]] += 1
+            self.uhd_fft.release(freq_result)
+        self._direction = -self._direction
+        n_rows = len(total)
+
+        covered = count > 0
+        waterfall = np.empty((n_rows, n_bins), dtype=np.float32)
+        waterfall[:, covered] = total[:, covered]/count[covered]
+        if not covered.all():
+            # gaps left by too little overlap, interpolate across them
+            x = np.flatnonzero(covered)
+            gaps = np.flatnonzero(~covered)
+            for row in waterfall:
+                row[gaps] = np.interp(gaps, x, row[covered])
+
+        return {
+            "freqs": self.start_freq + freq_res*np.arange(n_bins),
+            "spectrum": waterfall.mean(axis=0),
+            "waterfall": waterfall,
+            "hops": hops,
+            "duration": time.monotonic() - started,
+        }
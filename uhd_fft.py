@@ -1,6 +1,43 @@
-import uhd
+import contextlib
+import threading
+import time
 import numpy as np
-import matplotlib.pyplot as plt
+
+from buffer_pool import BufferPool
+from devices import UsrpDevice
+from fft_engine import FftEngine
+from metrics import Metrics
+from ring_buffer import RingBuffer
+from spectrum_stats import SpectrumStats
+from zoom import ZoomFft
+
+# operations a settings change requires, see UhdFft.configure()
+OP_DSP = "dsp"
+OP_ANTENNA = "antenna"
+OP_RATE = "rate"
+OP_TUNE = "tune"
+OP_GAIN = "gain"
+OP_STREAM = "stream"
+HARDWARE_OPS = {OP_ANTENNA, OP_RATE, OP_TUNE, OP_GAIN, OP_STREAM}
+
+SETTINGS = {
+    "center_freq": (float, {OP_TUNE}),
+    # the LO offset follows the bandwidth, so a rate change also retunes
+    "bandwidth": (float, {OP_RATE, OP_TUNE}),
+    "gain": (float, {OP_GAIN}),
+    "antenna_id": (int, {OP_ANTENNA}),
+    "channels": (lambda val: [int(c) for c in val], HARDWARE_OPS),
+    "fft_size": (int, {OP_DSP}),
+    "n_samples": (int, {OP_DSP}),
+    "window": (str, {OP_DSP}),
+    # 0 plain windowed FFT, else taps of a polyphase filter bank
+    "pfb_taps": (int, {OP_DSP}),
+    # zoom_span 0 is off, zoom_freq 0 follows center_freq
+    "zoom_freq": (float, {OP_DSP}),
+    "zoom_span": (float, {OP_DSP}),
+    "vmin": (float, {OP_DSP}),
+    "vmax": (float, {OP_DSP}),
+}
 
 
 class UhdFft():
@@ -9,6 +46,7 @@ class UhdFft():
     _center_freq = 796e6
     _bandwidth = 10e6
     _channel_id = 0
+    _channels = None
     _antenna_id = 0
     _antennas = None
     _antenna_name = None
@@ -16,15 +54,45 @@ class UhdFft():
     _fft_size = 1024
     _n_samples = int(100e3)
     _n_fft_steps = None
-    _usrp = None
+    _device = None
     _freq_res = None
     _time_res = None
     _gain = 32
-    _buffer = None
+    _buffers = None
+    _buffers_key = None
+    _flush_buffer = None
+    _recv_buffer = None
     _streamer = None
+    _stream_channels = None
+    _stream_lock = None
+    _ring = None
+    _ring_seconds = 0.25
+    _read_pos = 0
+    _rx_anchor = None
+    _rx_thread = None
+    _rx_running = False
+    _rx_timeout = 0.1
     _lo_offset = 2e6
     _vmin = -45
     _vmax = 0
+    _window = "hamming"
+    _pfb_taps = 0
+    _zoom_freq = 0.
+    _zoom_span = 0.
+    _zoom = None
+    _fft_engine = None
+    _transaction = None
+    _stats = None
+    _stats_key = None
+    _tune_cache = None
+    _tune_cache_size = 1024
+    _tune_results = None
+    _metrics = None
+    _timed = False
+    _timed_lead = 0.02
+    _settle_time = 1e-3
+    _ready_at = 0.
+    _capture_times = None
 
     @property
     def vmax(self):
@@ -32,7 +100,7 @@ class UhdFft():
 
     @vmax.setter
     def vmax(self, val):
-        self._vmax = float(val)
+        self.configure(vmax=val)
 
     @property
     def vmin(self):
@@ -40,7 +108,7 @@ class UhdFft():
 
     @vmin.setter
     def vmin(self, val):
-        self._vmin = float(val)
+        self.configure(vmin=val)
 
     @property
     def time_res(self):
@@ -56,8 +124,124 @@ class UhdFft():
 
     @fft_size.setter
     def fft_size(self, val):
-        self._fft_size = int(val)
-        self.update_config()
+        self.configure(fft_size=val)
+
+    @property
+    def n_samples(self):
+        return self._n_samples
+
+    @n_samples.setter
+    def n_samples(self, val):
+        self.configure(n_samples=val)
+
+    @property
+    def window(self):
+        return self._window
+
+    @window.setter
+    def window(self, val):
+        self.configure(window=val)
+
+    @property
+    def pfb_taps(self):
+        return self._pfb_taps
+
+    @pfb_taps.setter
+    def pfb_taps(self, val):
+        self.configure(pfb_taps=val)
+
+    @property
+    def zoom_freq(self):
+        return self._zoom_freq or self._center_freq
+
+    @zoom_freq.setter
+    def zoom_freq(self, val):
+        self.configure(zoom_freq=val)
+
+    @property
+    def zoom_span(self):
+        return self._zoom_span
+
+    @zoom_span.setter
+    def zoom_span(self, val):
+        self.configure(zoom_span=val)
+
+    @property
+    def view_center_freq(self):
+        # center of the displayed spectrum, the zoom band when zoomed
+        return (self._start_freq + self._end_freq)/2
+
+    @property
+    def fft_backend(self):
+        return self._fft_engine.backend
+
+    @fft_backend.setter
+    def fft_backend(self, val):
+        self._fft_engine.set_backend(val, self._fft_engine.workers)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def enable_stats(self, alpha=None, **kwargs):
+        self._stats = SpectrumStats(self._fft_size, alpha=alpha, **kwargs)
+        return self._stats
+
+    def disable_stats(self):
+        self._stats = None
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def buffers(self):
+        return self._buffers
+
+    def release(self, buf):
+        # hand a capture or spectrogram returned by this object back for reuse
+        return self._buffers.release(buf)
+
+    @property
+    def continuous(self):
+        return self._rx_running
+
+    @property
+    def timed(self):
+        return self._timed
+
+    def enable_timed(self, lead=None, settle_time=None, sync_clock=True):
+        # finite bursts at scheduled device times instead of starting and
+        # stopping a continuous stream. sync_clock sets the device clock to
+        # the host's unix time, leave it off when the device keeps GPS/PPS
+        # time.
+        if self._rx_running:
+            raise ValueError("Timed captures do not work in continuous mode")
+        if lead is not None:
+            self._timed_lead = lead
+        if settle_time is not None:
+            self._settle_time = settle_time
+        if sync_clock:
+            self._device.set_time_now(time.time())
+        self._ready_at = 0.
+        self._timed = True
+
+    def disable_timed(self):
+        self._timed = False
+
+    @property
+    def capture_time(self):
+        # start of the last capture: device time of its first sample in
+        # timed mode, estimated from the host clock otherwise
+        return self._capture_times[0] if self._capture_times else None
+
+    @property
+    def capture_times(self):
+        # one start time per row of the last capture
+        return list(self._capture_times or [])
+
+    def frame_times(self, n_frames, row=0):
+        return self._capture_times[row] + np.arange(n_frames)*self._time_res
 
     @property
     def center_freq(self):
@@ -65,8 +249,7 @@ class UhdFft():
 
     @center_freq.setter
     def center_freq(self, val):
-        self._center_freq = float(val)
-        self.update_config()
+        self.configure(center_freq=val)
 
     @property
     def bandwidth(self):
@@ -74,8 +257,7 @@ class UhdFft():
 
     @bandwidth.setter
     def bandwidth(self, val):
-        self._bandwidth = float(val)
-        self.update_config()
+        self.configure(bandwidth=val)
 
     @property
     def gain(self):
@@ -83,8 +265,15 @@ class UhdFft():
 
     @gain.setter
     def gain(self, val):
-        self._gain = float(val)
-        self.update_config()
+        self.configure(gain=val)
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    @channels.setter
+    def channels(self, val):
+        self.configure(channels=val)
 
     @property
     def antennas(self):
@@ -96,69 +285,275 @@ class UhdFft():
 
     @antenna_id.setter
     def antenna_id(self, val):
-        self._antenna_id = int(val)
-        self.update_antenna()
-        self.update_config()
+        self.configure(antenna_id=val)
 
     @property
     def antenna_name(self):
         return self._antennas[self._antenna_id]
 
-    @gain.setter
+    @antenna_name.setter
     def antenna_name(self, val):
-        self._antenna_id = self._antennas.index(val)
-        self.update_antenna()
-        self.update_config()
+        self.configure(antenna_name=val)
 
     def __init__(self,
                  center_freq=900e6,
                  bandwidth=5e6,
-                 gain=32):
+                 gain=32,
+                 fft_backend="numpy",
+                 fft_workers=1,
+                 device=None):
         self._gain = gain
         self._center_freq = center_freq
         self._bandwidth = bandwidth
+        self._channels = [self._channel_id]
+        self._tune_cache = {}
+        self._tune_results = {}
+        self._buffers = BufferPool()
+        self._metrics = Metrics()
+        self._metrics.gauge("ring_lost_samples",
+                            lambda: self._ring.lost if self._ring else None)
+        self._fft_engine = FftEngine(fft_backend, fft_workers)
+        self._zoom = ZoomFft(self._fft_engine)
+        self._stream_lock = threading.RLock()
+
+        self._device = device if device is not None else UsrpDevice()
+        self._antennas = self._device.get_rx_antennas(self._channel_id)
 
-        self._usrp = uhd.usrp.MultiUSRP()
-        self._antennas = self._usrp.get_rx_antennas(self._channel_id)
-
-        self.update_antenna()
         self.update_config()
 
     def stop_streamer(self):
         if self._streamer:
-            stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
+            stream_cmd = self._device.stream_cmd("stop_cont")
             self._streamer.issue_stream_cmd(stream_cmd)
 
     def start_streamer(self):
         if self._streamer:
-            stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+            stream_cmd = self._device.stream_cmd("start_cont")
             self._streamer.issue_stream_cmd(stream_cmd)
 
+    def flush_streamer(self):
+        metadata = self._device.rx_metadata()
+        shape = (len(self._stream_channels),
+                 self._streamer.get_max_num_samps())
+        if self._flush_buffer is None or self._flush_buffer.shape != shape:
+            self._flush_buffer = np.empty(shape, dtype=np.complex64)
+        while self._streamer.recv(self._flush_buffer, metadata,
+                                  self._rx_timeout):
+            pass
+
+    def recv(self, out, metadata, timeout=None):
+        # uhd only fills C-contiguous buffers (of anything else it fills a
+        # temporary copy), so the column slices of several channel rows are
+        # received through a scratch buffer and copied in
+        if timeout is None:
+            timeout = self._rx_timeout
+        if out.flags.c_contiguous:
+            return self._streamer.recv(out, metadata, timeout)
+        size = out.size
+        if self._recv_buffer is None or self._recv_buffer.size < size:
+            self._recv_buffer = np.empty(size, dtype=out.dtype)
+        scratch = self._recv_buffer[:size].reshape(out.shape)
+        samps = self._streamer.recv(scratch, metadata, timeout)
+        out[:, :samps] = scratch[:, :samps]
+        return samps
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # collect setter/configure() calls and apply them once on exit
+        if self._transaction is not None:
+            yield self
+            return
+        self._transaction = {}
+        try:
+            yield self
+            changes = self._transaction
+        finally:
+            self._transaction = None
+        self.configure(**changes)
+
+    def configure(self, **changes):
+        if self._transaction is not None:
+            self._transaction.update(changes)
+            return set()
+
+        # everything is cast and checked before anything is stored, so a
+        # bad value leaves the settings as they were
+        values = {}
+        for name, val in changes.items():
+            if name == "antenna_name":
+                name, val = "antenna_id", self._antennas.index(val)
+            if name not in SETTINGS:
+                raise ValueError("Unknown setting %s" % name)
+            cast, _ = SETTINGS[name]
+            val = cast(val)
+            if name == "antenna_id" and not 0 <= val < len(self._antennas):
+                print("Antenna id %d is out of range" % val)
+                print("Available: %s" % ", ".join(self._antennas))
+                continue
+            if name == "channels":
+                n_channels = self._device.get_rx_num_channels()
+                if not val or min(val) < 0 or max(val) >= n_channels:
+                    raise ValueError("Channels %s not available, device has "
+                                     "%d rx channels" % (val, n_channels))
+            values[name] = val
+        if "window" in values:
+            self._fft_engine.get_window(
+                values.get("fft_size", self._fft_size), values["window"])
+
+        ops = set()
+        for name, val in values.items():
+            if getattr(self, "_" + name) == val:
+                continue
+            setattr(self, "_" + name, val)
+            if name == "channels":
+                self._channel_id = val[0]
+            ops |= SETTINGS[name][1]
+
+        if ops:
+            self.apply_config(ops)
+        return ops
+
     def update_config(self):
+        self.apply_config(HARDWARE_OPS)
+
+    def apply_config(self, ops):
         self._sampling_rate = self._bandwidth
-        self._freq_res = self._sampling_rate/self._fft_size
-        self._time_res = (1/self._sampling_rate)*self._fft_size
-        self._start_freq = self._center_freq - self._bandwidth/2
-        self._end_freq = self._center_freq + self._bandwidth/2
+        view_rate, view_center = self._sampling_rate, self._center_freq
+        if self._zoom_span:
+            view_rate = self._zoom.output_rate(self._sampling_rate,
+                                               self._zoom_span)
+            view_center = self.zoom_freq
+            if abs(view_center - self._center_freq) + self._zoom_span/2 > \
+                    self._sampling_rate/2:
+                print("Zoom band %.3f MHz +- %.3f MHz is outside of the "
+                      "captured band" % (view_center/1e6,
+                                         self._zoom_span/2e6))
+        self._freq_res = view_rate/self._fft_size
+        self._time_res = (1/view_rate)*self._fft_size
+        self._start_freq = view_center - view_rate/2
+        self._end_freq = view_center + view_rate/2
         self._lo_offset = self._bandwidth
-        self.update_usrp_params()
+        buffers_key = (self._n_samples, self._fft_size,
+                       tuple(self._channels))
+        if buffers_key != self._buffers_key:
+            # idle buffers of the old sizes would never be handed out again
+            self._buffers.clear()
+            self._buffers_key = buffers_key
+        stats_key = (view_center, view_rate, self._fft_size)
+        if stats_key != self._stats_key:
+            # the bins moved, averages and holds of the old ones are void.
+            # Gain and antenna changes (capture_multi switches antennas on
+            # every frame) keep them.
+            if self._stats:
+                self._stats.reset()
+            self._stats_key = stats_key
+        restart = self._rx_running and (
+            8*self._n_samples > self._ring.size or
+            len(self._channels) != self._ring.channels)
+        if restart:
+            # the ring has to hold a few captures of the new size and a row
+            # per streamed channel, it is rebuilt once the stream is
+            self.stop_continuous()
+        if ops & HARDWARE_OPS:
+            self.apply_hardware(ops)
+        if restart:
+            self.start_continuous()
+
+    def apply_hardware(self, ops):
+        with self._stream_lock:
+            timed = self.schedule_commands(ops)
+            try:
+                if OP_ANTENNA in ops:
+                    self.update_antenna()
+                for channel in self._channels:
+                    if OP_RATE in ops:
+                        self._device.set_rx_rate(self._sampling_rate, channel)
+                    if OP_TUNE in ops:
+                        self.tune(channel)
+                    if OP_GAIN in ops:
+                        self._device.set_rx_gain(self._gain, channel)
+            finally:
+                if timed:
+                    self._device.clear_command_time()
+
+            channels = list(self._channels)
+            if OP_STREAM in ops or self._streamer is None or \
+                    self._stream_channels != channels:
+                self.stop_streamer()
+                self._streamer = None
+
+                # initialise streaming
+                self._streamer = self._device.get_rx_stream(channels)
+                self._stream_channels = channels
+                if self._rx_running:
+                    self.start_streamer()
+            elif self._rx_running and OP_RATE in ops:
+                # samples already in flight were taken at the old rate
+                self.stop_streamer()
+                self.flush_streamer()
+                self._rx_anchor = None
+                self.start_streamer()
+
+            self.invalidate_ring(self._settle_time)
+
+    def invalidate_ring(self, settle=0.):
+        # samples taken before now (plus `settle`) are stale. Some of them
+        # may still be on their way from the device, so the cut is placed by
+        # device time rather than after the samples written so far.
+        if not self._ring:
+            return
+        if self._rx_anchor is None:
+            self._ring.reset()
+            return
+        position, at = self._rx_anchor
+        now = self._device.get_time_now()
+        self._ring.reset(position + int(np.ceil(
+            (now + settle - at)*self._sampling_rate)))
+
+    def schedule_commands(self, ops):
+        # in timed mode the device carries out antenna, tune and gain
+        # changes a little ahead of now, so they do not block here, and the
+        # next capture starts once they settled. Rate and stream changes
+        # still happen right away.
+        if not self._timed or ops & {OP_RATE, OP_STREAM}:
+            return False
+        at = self.next_capture_time()
+        self._device.set_command_time(at)
+        self._ready_at = at + self._settle_time
+        return True
 
-        self.stop_streamer()
-        self._streamer = None
-
-        # initialise streaming
-        st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-        st_args.channels = [self._channel_id]
-        self._streamer = self._usrp.get_rx_stream(st_args)
-        # self.start_streamer()
-
-    def update_usrp_params(self):
-        tune_req = uhd.types.TuneRequest(
-            self._center_freq, self._lo_offset)  #
-        r = self._usrp.set_rx_freq(tune_req, self._channel_id)
-        self._usrp.set_rx_gain(self._gain, self._channel_id)
-        self._usrp.set_rx_rate(self._sampling_rate, self._channel_id)
-        # self._usrp.set_rx_bandwidth(5e6, self._channel_id)
+    def settle(self, seconds):
+        # keep the next `seconds` of samples out of captures, e.g. while a
+        # retuned LO settles
+        if self._timed:
+            # timed captures already start settle_time after the commands
+            self._ready_at += max(0., seconds - self._settle_time)
+            return
+        if self._ring:
+            self.invalidate_ring(seconds)
+            return
+        time.sleep(seconds)
+
+    def next_capture_time(self):
+        return max(self._device.get_time_now() + self._timed_lead,
+                   self._ready_at)
+
+    def tune(self, channel):
+        key = (self._center_freq, self._lo_offset, self._sampling_rate,
+               channel)
+        with self._metrics.timer("tune"):
+            result = self._device.tune(self._center_freq, self._lo_offset,
+                                       channel,
+                                       cached=self._tune_cache.get(key))
+        if len(self._tune_cache) >= self._tune_cache_size:
+            self._tune_cache.clear()
+        self._tune_cache[key] = result
+        self._tune_results[channel] = result
+        return result
+
+    def tune_result(self, channel=None):
+        return self._tune_results.get(
+            self._channel_id if channel is None else channel)
 
     def update_antenna(self):
         if len(self._antennas) <= self._antenna_id:
@@ -167,57 +562,290 @@ class UhdFft():
             return False
 
         self._antenna_name = self._antennas[self._antenna_id]
-        self._usrp.set_rx_antenna(self._antenna_name)
+        for channel in self._channels:
+            self._device.set_rx_antenna(self._antenna_name, channel)
         return True
 
     def show_info(self):
-        if not self._usrp:
-            print("USRP is not initialised!")
+        if not self._device:
+            print("Device is not initialised!")
             return False
         print("Antenna: %s" %
-              self._usrp.get_rx_antenna())
+              self._device.get_rx_antenna(self._channel_id))
         print("Frequency: %.2f" %
-              (self._usrp.get_rx_freq(self._channel_id)/1e6))
+              (self._device.get_rx_freq(self._channel_id)/1e6))
         return True
 
     def psd(self, samples):
-        window = np.hamming(self._fft_size)
-        result = np.multiply(window, samples)
-        result = np.fft.fft(result, self._fft_size)
-        result = np.fft.fftshift(result)
-        result = np.square(np.abs(result))
-        result = np.nan_to_num(10.0 * np.log10(result))
-        result = np.abs(result)
-        return result
+        return self.psd_frames(samples[:self._fft_size])[0]
+
+    def psd_frames(self, samples, out=None):
+        return self._fft_engine.psd(samples, self._fft_size, self._window,
+                                    out=out)
+
+    def start_continuous(self):
+        if self._rx_running:
+            return
+        if self._timed:
+            raise ValueError("Timed captures do not work in continuous mode")
+        with self._stream_lock:
+            max_write = 8*self._streamer.get_max_num_samps()
+            ring_size = max(8*self._n_samples,
+                            int(self._ring_seconds*self._sampling_rate))
+            self._ring = RingBuffer(ring_size + max_write,
+                                    len(self._stream_channels),
+                                    max_write=max_write)
+            self._read_pos = 0
+            self._rx_anchor = None
+            self._rx_running = True
+            self.start_streamer()
+        self._rx_thread = threading.Thread(target=self.rx_worker, daemon=True)
+        self._rx_thread.start()
+
+    def stop_continuous(self):
+        if not self._rx_running:
+            return
+        self._rx_running = False
+        self._rx_thread.join()
+        self._rx_thread = None
+        with self._stream_lock:
+            self.stop_streamer()
+            self.flush_streamer()
+            self._ring = None
+
+    def rx_worker(self):
+        metadata = self._device.rx_metadata()
+        while self._rx_running:
+            with self._stream_lock:
+                samps = self.recv(self._ring.write_view(), metadata)
+                if samps:
+                    # device time of the first sample, see invalidate_ring()
+                    self._rx_anchor = (self._ring.written,
+                                       self._device.rx_time(metadata))
+                    self._ring.commit(samps)
+            self.check_rx_status(metadata, ("none", "timeout"))
+
+    def check_rx_status(self, metadata, ok=("none",)):
+        # overflows, late packets etc. are counted per error code
+        status = self._device.rx_status(metadata)
+        if status in ok:
+            return True
+        self._metrics.inc("rx_" + status)
+        print(metadata.strerror())
+        return False
+
+    def read_latest(self, n_samples, out=None):
+        samples, self._read_pos = self._ring.latest(
+            n_samples, since=self._read_pos, out=out, timeout=1.0)
+        if samples is None:
+            raise RuntimeError("Timed out waiting for %d samples" % n_samples)
+        return samples
+
+    def iter_frames(self):
+        for samples in self._ring.frames(self._n_samples, timeout=1.0):
+            yield self.spectrogram(samples[0] if len(samples) == 1
+                                   else samples)
+
+    def dsp_settings(self):
+        # what spectrogram() uses of the settings, taken along with a
+        # capture so that it is processed the way it was captured even when
+        # configure() runs meanwhile
+        return {
+            "fft_size": self._fft_size,
+            "window": self._window,
+            "pfb_taps": self._pfb_taps,
+            "sampling_rate": self._sampling_rate,
+            "zoom_offset": self.zoom_freq - self._center_freq,
+            "zoom_span": self._zoom_span,
+        }
+
+    def spectrogram(self, samples, settings=None, signed=False):
+        # the result comes from the buffer pool, see release(). Plots and
+        # statistics use -|dB|; signed=True returns plain dB (for detection)
+        # and leaves that to fold()
+        settings = settings or self.dsp_settings()
+        fft_size = settings["fft_size"]
+        window = settings["window"]
+        pfb_taps = settings["pfb_taps"]
+        with self._metrics.timer("psd"):
+            if settings["zoom_span"]:
+                freq_result = self._zoom.psd(
+                    samples, settings["sampling_rate"],
+                    settings["zoom_offset"], settings["zoom_span"],
+                    fft_size, window, pfb_taps, folded=False)
+            elif pfb_taps:
+                freq_result = self._fft_engine.pfb_psd(
+                    samples, fft_size, pfb_taps, window, folded=False)
+            else:
+                shape = samples.shape[:-1] + \
+                    (samples.shape[-1] // fft_size, fft_size)
+                freq_result = self._fft_engine.psd(
+                    samples, fft_size, window,
+                    out=self._buffers.acquire(shape, np.float32),
+                    folded=False)
+        if signed:
+            return freq_result
+        return self.fold(freq_result)
+
+    def fold(self, freq_result):
+        # signed dB to -|dB| in place
+        np.abs(freq_result, out=freq_result)
+        np.negative(freq_result, out=freq_result)
+        if self._stats:
+            # statistics follow the primary input of stacked captures
+            self._stats.update(freq_result[0] if freq_result.ndim == 3
+                               else freq_result)
+        return freq_result
 
     def usrp_recv(self):
-        self.start_streamer()
-        metadata = uhd.types.RXMetadata()
-        buffer = np.empty((1, self._n_samples), dtype=np.complex64)
-        samples = np.empty((1, self._n_samples), dtype=np.complex64)
-        recv_samps = 0
+        samples = self.capture_all()
+        freq_result = self.spectrogram(samples[0])
+        self.release(samples)
+        return freq_result
 
-        while recv_samps < self._n_samples:
-            samps = self._streamer.recv(buffer, metadata)
-            if metadata.error_code != uhd.types.RXMetadataErrorCode.none:
-                print(metadata.strerror())
-            if samps:
-                real_samps = min(self._n_samples - recv_samps, samps)
-                samples[:, recv_samps:recv_samps +
-                        real_samps] = buffer[:, 0:real_samps]
-                recv_samps += real_samps
-
-        samples = samples[self._channel_id]
+    def capture(self):
+        return self.capture_all()[0]
+
+    def capture_multi(self, n_inputs=2):
+        # one row per input: the streamed channels when there are enough of
+        # them, otherwise the antennas of the first channel one after another
+        if len(self._stream_channels) >= n_inputs:
+            return self.capture_all()[:n_inputs]
+
+        if self._timed and len(self._stream_channels) == 1:
+            return self.capture_multi_timed(n_inputs)
+
+        samples = self._buffers.acquire((n_inputs, self._n_samples),
+                                        np.complex64)
+        prev_antenna_id = self._antenna_id
+        times = []
+        for i in range(n_inputs):
+            self.configure(
+                antenna_id=(prev_antenna_id + i) % len(self._antennas))
+            if len(self._stream_channels) == 1:
+                self.capture_all(out=samples[i:i+1])
+            else:
+                captured = self.capture_all()
+                samples[i] = captured[0]
+                self.release(captured)
+            times.append(self._capture_times[0])
+        self.configure(antenna_id=prev_antenna_id)
+        self._capture_times = times
+        return samples
+
+    def capture_multi_timed(self, n_inputs):
+        # every antenna switch and burst is queued on the device up front,
+        # a switch takes effect settle_time before its burst
+        samples = self._buffers.acquire((n_inputs, self._n_samples),
+                                        np.complex64)
+        duration = self._n_samples/self._sampling_rate
+        step = duration + self._settle_time
+        start = self.next_capture_time()
+        with self._metrics.timer("recv"):
+            for i in range(n_inputs):
+                if i:
+                    self.switch_antenna_at(i, start + i*step -
+                                           self._settle_time)
+                self.issue_burst(self._n_samples, start + i*step)
+            if n_inputs > 1:
+                # back to the selected antenna right after the last burst
+                end = start + (n_inputs - 1)*step + duration
+                self.switch_antenna_at(0, end)
+                self._ready_at = end + self._settle_time
+            self._capture_times = [
+                self.recv_burst(samples[i:i+1], start + i*step)
+                for i in range(n_inputs)]
+        return samples
+
+    def switch_antenna_at(self, offset, at):
+        # antenna `offset` places after the selected one, at device time `at`
+        antenna_id = (self._antenna_id + offset) % len(self._antennas)
+        name = self._antennas[antenna_id]
+        self._device.set_command_time(at)
+        try:
+            for channel in self._channels:
+                self._device.set_rx_antenna(name, channel)
+        finally:
+            self._device.clear_command_time()
+
+    def issue_burst(self, n_samples, at):
+        stream_cmd = self._device.stream_cmd("num_done", n_samples, at)
+        self._streamer.issue_stream_cmd(stream_cmd)
+
+    def recv_burst(self, out, at):
+        # receive a burst issued for device time `at` into `out` and return
+        # the device time of its first sample
+        metadata = self._device.rx_metadata()
+        n_samples = out.shape[1]
+        recv_samps = 0
+        start = None
+        timeout = max(0., at - self._device.get_time_now()) + \
+            self._rx_timeout
+        while recv_samps < n_samples:
+            samps = self.recv(out[:, recv_samps:], metadata, timeout)
+            if not self.check_rx_status(metadata):
+                self.abort_bursts(self._device.rx_status(metadata))
+            if start is None:
+                start = self._device.rx_time(metadata)
+            recv_samps += samps
+            timeout = self._rx_timeout
+        return start
+
+    def abort_bursts(self, status):
+        # uhd names the late command error code "late"
+        if status == "late":
+            # the host could not keep ahead of the device
+            self._timed_lead = min(1.0, 2*self._timed_lead)
+            print("Timed commands were late, scheduling %.0f ms ahead" %
+                  (self._timed_lead*1e3))
+        # drop bursts still queued or in flight
         self.stop_streamer()
+        self.flush_streamer()
+        raise RuntimeError("Timed capture failed: %s" % status)
 
-        n_fft_steps = int(np.floor(len(samples)/self._fft_size))
-
-        freq_result = np.zeros([n_fft_steps, self._fft_size])
-        for i in range(n_fft_steps):
-            bins = -1*self.psd(samples[i*self._fft_size:(i+1)*self._fft_size])
-            freq_result[i] = bins
+    def usrp_recv_multi(self, n_inputs=2):
+        samples = self.capture_multi(n_inputs)
+        freq_result = self.spectrogram(samples)
+        self.release(samples)
         return freq_result
 
+    def capture_all(self, out=None):
+        # (channels, n_samples) in `out` or a pooled buffer, see release()
+        if out is None:
+            out = self._buffers.acquire(
+                (len(self._stream_channels), self._n_samples), np.complex64)
+        with self._metrics.timer("recv"):
+            if self._rx_running:
+                out = self.read_latest(self._n_samples, out=out)
+                self.estimate_capture_times(len(out))
+                return out
+
+            if self._timed:
+                start = self.next_capture_time()
+                self.issue_burst(self._n_samples, start)
+                self._capture_times = [self.recv_burst(out, start)]*len(out)
+                return out
+
+            self.start_streamer()
+            metadata = self._device.rx_metadata()
+            recv_samps = 0
+
+            while recv_samps < self._n_samples:
+                # straight into the remaining part of every channel row,
+                # recv never returns more than fits
+                samps = self.recv(out[:, recv_samps:], metadata)
+                self.check_rx_status(metadata)
+                recv_samps += samps
+
+            self.stop_streamer()
+            self.estimate_capture_times(len(out))
+            return out
+
+    def estimate_capture_times(self, n_rows):
+        # the capture ended about now
+        self._capture_times = [
+            time.time() - self._n_samples/self._sampling_rate]*n_rows
+
     def format_freq_ticks(self, ticks):
         return (self._start_freq + int(self._freq_res) * ticks)/1e6
 
@@ -225,6 +853,7 @@ class UhdFft():
         return np.round(self._time_res*ticks*1e3)
 
     def plot_spectogram(self, ax, freq_result):
+        import matplotlib.pyplot as plt
         cmap = plt.get_cmap("inferno")
         cf = ax.pcolormesh(freq_result, cmap=cmap,
                            vmax=self._vmax, vmin=self._vmin)
@@ -242,6 +871,7 @@ class UhdFft():
             rotation=45)
 
     def plot(self, freq_result):
+        import matplotlib.pyplot as plt
         f, ax = plt.subplots(2, 1, sharex=True)
         plt.subplots_adjust(hspace=.0)
         cf = self.plot_spectogram(ax[0], freq_result)
@@ -3,26 +3,206 @@ import threading
 import time
 import base64
 import io
-import matplotlib.pyplot as plt
+import json
+import itertools
+import concurrent.futures
+import numpy as np
 
+import wire_format
+from decimate import reduce_spectrogram
+from metrics import MetricsServer
+from params_channel import ParamsChannel
+from pipeline import Pipeline, Stage, DROP_OLDEST
+from renderer import SpectrogramRenderer
+from scheduler import AdaptiveScheduler
 from uhd_fft import UhdFft
 
+_renderers = {}
+
+# remote param name -> UhdFft attribute
+PARAMS = {
+    "cf": "center_freq",
+    "antennaGain": "gain",
+    "fftSize": "fft_size",
+    "samplingRate": "bandwidth",
+    "powerMin": "vmin",
+    "powerMax": "vmax",
+    "pfbTaps": "pfb_taps",
+    "zoomFreq": "zoom_freq",
+    "zoomSpan": "zoom_span",
+}
+
+
+def render_fast(meta, freq_result, freq_result2):
+    # module level so it can run in a process pool; one renderer per process
+    renderer = _renderers.get(meta["image_format"])
+    if renderer is None:
+        renderer = SpectrogramRenderer(image_format=meta["image_format"])
+        _renderers[meta["image_format"]] = renderer
+    renderer.vmin = meta["vmin"]
+    renderer.vmax = meta["vmax"]
+    return renderer.render(freq_result, freq_result, freq_result2)
+
+
+def encode_result(meta, freq_result, image):
+    if meta["wire"] is None:
+        result = {
+            "room": meta["room"],
+            "freq": freq_result.tolist(),
+        }
+        if image:
+            result["image"] = base64.encodebytes(image).decode("ascii")
+        if meta.get("stats"):
+            result["stats"] = {k: v.tolist() if hasattr(v, "tolist") else v
+                               for k, v in meta["stats"].items()}
+        if meta.get("metrics"):
+            result["metrics"] = meta["metrics"]
+        if meta.get("t_start") is not None:
+            # frame i was taken at t_start + i*time_res
+            result["t_start"] = meta["t_start"]
+            result["time_res"] = meta["time_res"]
+        return json.dumps(result).encode(), "application/json"
+
+    encoding, compression, transport = meta["wire"]
+    frame = wire_format.encode(freq_result, encoding, compression,
+                               center_freq=meta["center_freq"],
+                               freq_res=meta["freq_res"],
+                               time_res=meta["time_res"],
+                               image=image,
+                               t_start=meta.get("t_start") or 0.0)
+    if transport == "msgpack":
+        return (wire_format.pack_msgpack(meta["room"], frame),
+                wire_format.MSGPACK_CONTENT_TYPE)
+    return frame, wire_format.CONTENT_TYPE
+
+
+def encode_events(meta):
+    # compact result of events mode: what was found between t_start and
+    # t_end in the band, no spectrogram
+    events = meta["events"]
+    return json.dumps({
+        "room": meta["room"],
+        "t_start": events["t_start"],
+        "t_end": events["t_end"],
+        "center_freq": meta["center_freq"],
+        "bandwidth": meta["fft_size"]*meta["freq_res"],
+        "noise_level": events["noise_level"],
+        "events": events["events"],
+    }).encode(), wire_format.EVENTS_CONTENT_TYPE
+
+
+def render_and_encode(meta, freq_result, freq_result2):
+    # stage timings are taken here so they also work in a process pool
+    started = time.perf_counter()
+    image = render_fast(meta, freq_result, freq_result2) \
+        if meta["image_format"] else b""
+    rendered = time.perf_counter()
+    body, content_type = encode_result(meta, freq_result, image)
+    timings = {"render": rendered - started,
+               "encode": time.perf_counter() - rendered}
+    return body, content_type, timings
+
 
 class UhdFftRemote():
     params = {}
     base_url = ""
     room_id = "test"
     params_thread = None
+    params_channel = None
+    session = None
+    output_size = (None, None)
+    pooling = "max"
     running = True
     params_update_interval = 0.25
     update_interval = 0.1
+    encoding = "auto"
+    binary_supported = True
+    render_mode = "fast"
+    image_format = "png"
+    data_only = False
+    scheduler = None
+    _secondary = None
+    pipeline = None
+    encode_pool = None
+    metrics = None
+    metrics_server = None
+    metrics_in_payload = False
+    store = None
+    playback = None
+    _playback_iter = None
+    detector = None
+    keyframe_interval = 10.0
+    _last_keyframe = None
+    stage_config = {
+        "dsp": {"workers": 1, "queue_size": 2, "policy": DROP_OLDEST},
+        "encode": {"workers": 1, "queue_size": 2, "policy": DROP_OLDEST},
+        "upload": {"workers": 1, "queue_size": 2, "policy": DROP_OLDEST},
+    }
 
-    def __init__(self, base_url="http://localhost:8000", room_id="test"):
+    def __init__(self, base_url="http://localhost:8000", room_id="test",
+                 fft_backend="numpy", fft_workers=1, continuous=False,
+                 device=None, encoding="auto", render_mode="fast",
+                 image_format="png", stage_config=None, encode_processes=0,
+                 params_mode="poll", channels=None, stats_alpha=None,
+                 output_size=(None, None), pooling="max", metrics_port=None,
+                 metrics_in_payload=False, store=None, playback=None,
+                 data_only=False, target_rate=None, latency_budget=None,
+                 adapt=True, detector=None, keyframe_interval=10.0,
+                 timed=False, timed_lead=None, sync_clock=True):
         self.uhd_fft = UhdFft(center_freq=796e6,
                               bandwidth=10e6,
-                              gain=38)
+                              gain=38,
+                              fft_backend=fft_backend,
+                              fft_workers=fft_workers,
+                              device=device)
+        if channels:
+            self.uhd_fft.channels = channels
+        if stats_alpha is not None:
+            self.uhd_fft.enable_stats(alpha=stats_alpha or None)
+        if continuous:
+            self.uhd_fft.start_continuous()
+        if timed:
+            self.uhd_fft.enable_timed(lead=timed_lead, sync_clock=sync_clock)
         self.room_id = room_id
+        self.encoding = encoding
+        self.render_mode = render_mode
+        self.image_format = image_format
+        self.data_only = data_only
+        self.output_size = output_size
+        self.pooling = pooling
+        self.metrics = self.uhd_fft.metrics
+        self.scheduler = AdaptiveScheduler(
+            self.metrics, self.uhd_fft.n_samples,
+            target_rate=target_rate or 1/self.update_interval,
+            latency_budget=latency_budget, adapt=adapt)
+        self.metrics.gauge("scheduler", self.scheduler.state, label="knob")
+        self.metrics_in_payload = metrics_in_payload
+        self.store = store
+        self.playback = playback
+        if playback is not None:
+            self._playback_iter = iter(playback)
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        if metrics_port:
+            self.metrics_server = MetricsServer(self.metrics,
+                                                metrics_port).start()
+        self.stage_config = {k: dict(v) for k, v in self.stage_config.items()}
+        for name, config in (stage_config or {}).items():
+            self.stage_config[name].update(config)
+        if encode_processes:
+            self.encode_pool = concurrent.futures.ProcessPoolExecutor(
+                encode_processes)
+        self._seq = itertools.count()
+        self._last_uploaded = -1
         self.base_url = base_url
+        self.session = requests.Session()
+        self._params_lock = threading.Lock()
+        self._param_changes = {}
+        self.params_channel = ParamsChannel(
+            base_url, room_id, mode=params_mode,
+            interval=self.params_update_interval,
+            on_change=self.on_params_change)
+        self.params_channel.metrics = self.metrics
         self.params_thread = threading.Thread(
             target=self.receive_params_worker,
             daemon=True)
@@ -34,39 +214,99 @@ class UhdFftRemote():
         return None
 
     def receive_params_worker(self):
-        requests.post("%s/create_room?room=%s" % (self.base_url, self.room_id))
-        while self.running:
-            try:
-                self.recieve_params()
-            except Exception as err:
-                print("Error receiving remote params...")
-                print(err)
-            finally:
-                time.sleep(self.params_update_interval)
-        self.running = False
+        self.params_channel.run()
 
-    def recieve_params(self):
-        url = "%s/params?room=%s" % (self.base_url, self.room_id)
-        resp = requests.get(url)
-        self.params = resp.json()
+    def on_params_change(self, changes):
+        with self._params_lock:
+            self.params = self.params_channel.params
+            self._param_changes.update(changes)
 
-    def send_result(self, freq_result, freq_result2):
-        url = "%s/result?room=%s" % (self.base_url, self.room_id)
-        result = {
+    def take_param_changes(self):
+        with self._params_lock:
+            changes, self._param_changes = self._param_changes, {}
+        return changes
+
+    def negotiate_wire_format(self):
+        encoding = self.encoding
+        if encoding == "auto":
+            encoding = self.extract_param("encoding") or "json"
+        if encoding == "json" or not self.binary_supported:
+            return None
+        compression = self.extract_param("compression") or "none"
+        transport = self.extract_param("transport") or "raw"
+        return encoding, compression, transport
+
+    def snapshot(self):
+        return {
             "room": self.room_id,
-            "freq": self.ndarray_to_list(freq_result),
-            "image": self.make_plot(freq_result, freq_result2)
+            "vmin": self.uhd_fft.vmin,
+            "vmax": self.uhd_fft.vmax,
+            "center_freq": self.uhd_fft.view_center_freq,
+            "freq_res": self.uhd_fft.freq_res,
+            "time_res": self.uhd_fft.time_res,
+            "fft_size": self.uhd_fft.fft_size,
+            "bandwidth": self.uhd_fft.bandwidth,
+            "gain": self.uhd_fft.gain,
+            "antenna": self.uhd_fft.antenna_name,
+            "output_size": self.output_size,
+            "image_format": self.image_format if self.wants_image()
+            else None,
+            "wire": self.negotiate_wire_format(),
+            "stats": self.uhd_fft.stats.traces() if self.uhd_fft.stats
+            else None,
+            "metrics": self.metrics.snapshot() if self.metrics_in_payload
+            else None,
+            "events": None,
+            "t_start": None,
         }
-        resp = requests.post(url, json=result)
+
+    def wants_image(self):
+        # the server can switch images off for the room with image=false
+        if self.data_only:
+            return False
+        image = self.extract_param("image")
+        return image is None or str(image).lower() not in ("0", "false",
+                                                           "none", "no")
+
+    def send_result(self, freq_result, freq_result2):
+        meta = self.snapshot()
+        image = self.render_image(freq_result, freq_result2) \
+            if meta["image_format"] else b""
+        body, content_type = encode_result(meta, freq_result, image)
+        return self.upload_result(meta, body, content_type)
+
+    def upload_result(self, meta, body, content_type):
+        url = "%s/result?room=%s" % (self.base_url, self.room_id)
+        try:
+            with self.metrics.timer("upload"):
+                resp = self.session.post(
+                    url, data=body, headers={"Content-Type": content_type})
+        except requests.RequestException:
+            self.metrics.inc("http_errors")
+            raise
+        if resp.status_code >= 400:
+            self.metrics.inc("http_errors")
+        if meta["wire"] and resp.status_code >= 400:
+            print("Server rejected binary result (%d), using JSON" %
+                  resp.status_code)
+            self.binary_supported = False
+        return resp
 
     @staticmethod
     def ndarray_to_list(freq_result):
-        result = []
-        for r in freq_result:
-            result.append(list(r))
-        return result
+        return freq_result.tolist()
 
     def make_plot(self, freq_result, freq_result2):
+        image = self.render_image(freq_result, freq_result2)
+        return base64.encodebytes(image).decode("ascii")
+
+    def render_image(self, freq_result, freq_result2):
+        if self.render_mode == "pretty":
+            return self.render_matplotlib(freq_result, freq_result2)
+        return render_fast(self.snapshot(), freq_result, freq_result2)
+
+    def render_matplotlib(self, freq_result, freq_result2):
+        import matplotlib.pyplot as plt
         bts = io.BytesIO()
 
         with plt.style.context(('dark_background')):
@@ -87,44 +327,230 @@ class UhdFftRemote():
             ax[1].legend()
 
             fig.savefig(bts, format='png')
-            bts.seek(0)
             plt.close()
-        return base64.encodebytes(bts.read()).decode("ascii")
+        return bts.getvalue()
+
+    def apply_params(self):
+        changes = self.take_param_changes()
+        self.uhd_fft.configure(**{attr: changes[param]
+                                  for param, attr in PARAMS.items()
+                                  if changes.get(param) is not None})
+        height, width = self.output_size
+        if changes.get("outputHeight") is not None:
+            height = int(changes["outputHeight"]) or None
+        if changes.get("outputWidth") is not None:
+            width = int(changes["outputWidth"]) or None
+        self.output_size = (height, width)
+
+    def acquire(self):
+        self.apply_params()
+        frame = {"seq": next(self._seq), "meta": self.snapshot()}
+        if frame["seq"] % self.scheduler.image_every:
+            frame["meta"]["image_format"] = None
+        if self.playback is not None:
+            return self.acquire_playback(frame)
+        if self.switching() and self._secondary is not None and \
+                frame["seq"] % self.scheduler.antenna_every:
+            # off duty: only the current antenna, the other input is
+            # filled in from its last capture
+            frame["samples"] = self.uhd_fft.capture_all()[:1]
+        else:
+            frame["samples"] = self.uhd_fft.capture_multi(2)
+        frame["dsp"] = self.uhd_fft.dsp_settings()
+        frame["meta"]["t_start"] = self.uhd_fft.capture_time
+        return frame
+
+    def switching(self):
+        # two inputs from one streamed channel means switching antennas
+        return len(self.uhd_fft.channels) < 2
+
+    def acquire_playback(self, frame):
+        try:
+            freq_result, recorded = next(self._playback_iter)
+        except StopIteration:
+            print("Playback finished")
+            self.running = False
+            return None
+        meta = frame["meta"]
+        freq_res = recorded["bandwidth"]/recorded["fft_size"]
+        freqs = recorded["freqs"]
+        meta.update({
+            "center_freq": freqs[0] + freq_res*len(freqs)/2,
+            "freq_res": freq_res,
+            "time_res": recorded["time_res"],
+            "fft_size": recorded["fft_size"],
+        })
+        # the same recording stands in for both inputs
+        frame["results"] = np.broadcast_to(freq_result,
+                                           (2,) + freq_result.shape)
+        meta["t_start"] = recorded["time"]
+        return frame
+
+    def dsp_stage(self, frame):
+        # (inputs, frames, bins) in one batched transform
+        meta = frame["meta"]
+        if "samples" in frame:
+            samples = frame.pop("samples")
+            # detection needs dB with its sign, the rest gets it folded
+            results = self.uhd_fft.spectrogram(samples, frame["dsp"],
+                                               signed=True)
+            self.uhd_fft.release(samples)
+            results = self.fill_secondary(results)
+            if self.detector:
+                self.detect(frame, results[0])
+            self.uhd_fft.fold(results)
+            if self.store:
+                # indexed by the band of the bins, not of the capture
+                self.store.append(results[0], meta["t_start"], dict(
+                    meta, bandwidth=meta["fft_size"]*meta["freq_res"]))
+        else:
+            # recordings only hold the folded values
+            results = frame.pop("results")
+            if self.detector:
+                self.detect(frame, results[0])
+        if self.detector and not self.is_keyframe(meta["t_start"]):
+            self.uhd_fft.release(results)
+            return frame
+        height, width = meta["output_size"]
+        if height or width:
+            n_frames, n_bins = results.shape[-2:]
+            reduced = reduce_spectrogram(results, height, width,
+                                         self.pooling, self.pooling)
+            if reduced is not results:
+                self.uhd_fft.release(results)
+            results = reduced
+            meta["freq_res"] *= n_bins/results.shape[-1]
+            meta["time_res"] *= n_frames/results.shape[-2]
+        frame["results"] = results
+        return frame
+
+    def detect(self, frame, freq_result):
+        meta = frame["meta"]
+        t_start = meta["t_start"]
+        t_end = t_start + len(freq_result)*meta["time_res"]
+        with self.metrics.timer("detect"):
+            events = self.detector.detect(
+                freq_result, t_start, meta["time_res"], meta["center_freq"],
+                meta["freq_res"])
+        self.metrics.inc("events", len(events))
+        meta["events"] = {
+            "t_start": t_start,
+            "t_end": t_end,
+            "noise_level": self.detector.noise_level,
+            "events": events,
+        }
+
+    def is_keyframe(self, timestamp):
+        # in events mode the full spectrogram is only sent now and then
+        if self._last_keyframe is None or \
+                timestamp - self._last_keyframe >= self.keyframe_interval:
+            self._last_keyframe = timestamp
+            return True
+        return False
+
+    def fill_secondary(self, results):
+        if len(results) > 1:
+            if self.scheduler.antenna_every > 1:
+                self._secondary = results[1].copy()
+            return results
+        secondary = self._secondary
+        if secondary is None or secondary.shape != results.shape[1:]:
+            secondary = results[0]
+        filled = np.stack([results[0], secondary])
+        self.uhd_fft.release(results)
+        return filled
+
+    def encode_stage(self, frame):
+        meta = frame["meta"]
+        if meta["events"] is not None:
+            with self.metrics.timer("encode"):
+                frame["events_body"] = encode_events(meta)
+        if "results" not in frame:
+            return frame
+        results = frame.pop("results")
+        freq_result, freq_result2 = results
+        if self.render_mode == "pretty" and meta["image_format"]:
+            # matplotlib is neither picklable nor thread safe, keep it here
+            with self.metrics.timer("render"):
+                image = self.render_matplotlib(freq_result, freq_result2)
+            with self.metrics.timer("encode"):
+                frame["body"] = encode_result(meta, freq_result, image)
+        else:
+            if self.encode_pool:
+                body, content_type, timings = self.encode_pool.submit(
+                    render_and_encode, meta, freq_result, freq_result2
+                ).result()
+            else:
+                body, content_type, timings = render_and_encode(
+                    meta, freq_result, freq_result2)
+            for name, seconds in timings.items():
+                self.metrics.observe(name, seconds)
+            frame["body"] = body, content_type
+        # the payload holds its own copy of the data by now
+        self.uhd_fft.release(results)
+        return frame
+
+    def upload_stage(self, frame):
+        # with several encode/upload workers frames can overtake each other
+        if frame["seq"] < self._last_uploaded:
+            self.metrics.inc("stale_frames")
+            return None
+        self._last_uploaded = frame["seq"]
+        if "events_body" in frame:
+            self.upload_result(dict(frame["meta"], wire=None),
+                               *frame["events_body"])
+        if "body" in frame:
+            self.upload_result(frame["meta"], *frame["body"])
+        self.metrics.tick("frame_rate")
+        return None
+
+    def build_pipeline(self):
+        encode_config = dict(self.stage_config["encode"])
+        if self.render_mode == "pretty":
+            encode_config["workers"] = 1
+        pipeline = Pipeline([
+            Stage("dsp", self.dsp_stage, **self.stage_config["dsp"]),
+            Stage("encode", self.encode_stage, **encode_config),
+            Stage("upload", self.upload_stage, **self.stage_config["upload"]),
+        ])
+        self.metrics.gauge("queue_depth", pipeline.queue_depths,
+                           label="stage")
+        self.metrics.gauge("dropped_frames", pipeline.dropped, label="stage")
+        return pipeline
+
+    def adapt(self):
+        if self.scheduler.frame_done(self.switching()):
+            print("Adapted: %s" % ", ".join(
+                "%s=%s" % item for item in self.scheduler.state().items()))
+            if self.scheduler.n_samples != self.uhd_fft.n_samples:
+                self.uhd_fft.n_samples = self.scheduler.n_samples
 
     def measurement_worker(self):
-        while self.running:
-            try:
-                center_freq = self.extract_param("cf")
-                gain = self.extract_param("antennaGain")
-                fft_size = self.extract_param("fftSize")
-                sampling_rate = self.extract_param("samplingRate")
-                power_min = self.extract_param("powerMin")
-                power_max = self.extract_param("powerMax")
-                if not center_freq is None:
-                    self.uhd_fft.center_freq = center_freq
-                if not gain is None:
-                    self.uhd_fft.gain = gain
-                if not fft_size is None:
-                    self.uhd_fft.fft_size = fft_size
-                if not sampling_rate is None:
-                    self.uhd_fft.bandwidth = sampling_rate
-                if not power_min is None:
-                    self.uhd_fft.vmin = power_min
-                if not power_max is None:
-                    self.uhd_fft.vmax = power_max
-
-                prev_antenna_id = self.uhd_fft.antenna_id
-                next_antenna_id = (prev_antenna_id + 1) % 2
-
-                freq_result1 = self.uhd_fft.usrp_recv()
-                self.uhd_fft.antenna_id = next_antenna_id
-                freq_result2 = self.uhd_fft.usrp_recv()
-                self.uhd_fft.antenna_id = prev_antenna_id
-
-                self.send_result(freq_result1, freq_result2)
-            except Exception as err:
-                print("Error measuring...")
-                print(err)
-            finally:
-                time.sleep(self.update_interval)
+        self.pipeline = self.build_pipeline()
+        self.pipeline.start()
+        try:
+            while self.running:
+                self.scheduler.wait()
+                if self.scheduler.should_skip(self.pipeline.queue_depths()):
+                    # the uplink is behind, a newer frame will do
+                    self.metrics.inc("skipped_frames")
+                    continue
+                try:
+                    frame = self.acquire()
+                    if frame is not None:
+                        self.pipeline.put(frame)
+                        self.adapt()
+                except Exception as err:
+                    self.metrics.inc("measure_errors")
+                    print("Error measuring...")
+                    print(err)
+        finally:
+            self.params_channel.running = False
+            self.pipeline.stop()
+            if self.encode_pool:
+                self.encode_pool.shutdown()
+            if self.metrics_server:
+                self.metrics_server.stop()
+            if self.store:
+                self.store.close()
         self.running = False
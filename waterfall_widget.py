@@ -0,0 +1,92 @@
+import numpy as np
+
+from kivy.graphics import Color, Line, Rectangle
+from kivy.graphics.texture import Texture
+from kivy.uix.widget import Widget
+
+
+class WaterfallWidget(Widget):
+    # Scrolling waterfall kept in a GPU texture used as a ring: new rows
+    # are blitted at the write position and the texture coordinates are
+    # shifted so the newest row is always drawn at the top. Nothing is
+    # redrawn from history, the per-frame cost only depends on the number
+    # of new rows. The average power trace below it is a single Line whose
+    # points are replaced in place.
+    history = 512
+    trace_fraction = .3
+    vmin = -45
+    vmax = 0
+    _texture = None
+    _rect = None
+    _line = None
+    _row = 0
+    _trace = None
+
+    def __init__(self, history=512, **kwargs):
+        super(WaterfallWidget, self).__init__(**kwargs)
+        self.history = history
+        with self.canvas:
+            Color(1, 1, 1)
+            self._rect = Rectangle()
+            Color(0, .8, 0)
+            self._line = Line(points=[], width=1)
+        self.bind(pos=self.update_layout, size=self.update_layout)
+
+    def create_texture(self, width):
+        self._texture = Texture.create(size=(width, self.history),
+                                       colorfmt="rgba")
+        self._texture.wrap = "repeat"
+        self._texture.mag_filter = "nearest"
+        self._texture.blit_buffer(
+            bytes(width*self.history*4), colorfmt="rgba", bufferfmt="ubyte")
+        self._row = 0
+        self._rect.texture = self._texture
+        self.update_layout()
+
+    def waterfall_area(self):
+        trace_height = self.height*self.trace_fraction
+        return ((self.x, self.y + trace_height),
+                (self.width, self.height - trace_height))
+
+    def update_layout(self, *args):
+        self._rect.pos, self._rect.size = self.waterfall_area()
+        self.update_tex_coords()
+        if self._trace is not None:
+            self.set_trace(self._trace)
+
+    def update_tex_coords(self):
+        # oldest row at the bottom, newest (just below the write position)
+        # at the top; repeat wrapping takes care of v < 0
+        top = self._row/self.history
+        bottom = top - 1
+        self._rect.tex_coords = (0, bottom, 1, bottom, 1, top, 0, top)
+
+    def add_rows(self, rgba):
+        width = rgba.shape[1]
+        if self._texture is None or self._texture.width != width:
+            self.create_texture(width)
+        rgba = rgba[-self.history:]
+        n_rows = len(rgba)
+
+        first = min(n_rows, self.history - self._row)
+        self.blit(rgba[:first], self._row)
+        if first < n_rows:
+            self.blit(rgba[first:], 0)
+        self._row = (self._row + n_rows) % self.history
+        self.update_tex_coords()
+        self.canvas.ask_update()
+
+    def blit(self, rgba, row):
+        self._texture.blit_buffer(
+            np.ascontiguousarray(rgba).tobytes(), colorfmt="rgba",
+            bufferfmt="ubyte", pos=(0, row),
+            size=(rgba.shape[1], rgba.shape[0]))
+
+    def set_trace(self, avg_power):
+        self._trace = avg_power
+        height = self.height*self.trace_fraction
+        points = np.empty(2*len(avg_power), dtype=np.float32)
+        points[0::2] = self.x + np.linspace(0, self.width, len(avg_power))
+        level = (avg_power - self.vmin)/(self.vmax - self.vmin)
+        points[1::2] = self.y + np.clip(level, 0, 1)*height
+        self._line.points = points.tolist()
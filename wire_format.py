@@ -0,0 +1,124 @@
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b"UFFT"
+VERSION = 2
+# version 2 added t_start, the time of the first frame
+HEADERS = {
+    1: struct.Struct("<4sBBBBIIffdddI"),
+    2: struct.Struct("<4sBBBBIIffddddI"),
+}
+HEADER = HEADERS[VERSION]
+
+CONTENT_TYPE = "application/x-uhd-fft"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+# compact JSON of detected events, sent instead of results in events mode
+EVENTS_CONTENT_TYPE = "application/vnd.uhd-fft-events+json"
+
+DTYPES = {"f32": 0, "f16": 1, "u8": 2}
+COMPRESSIONS = {"none": 0, "deflate": 1, "zstd": 2}
+TRANSPORTS = ("raw", "msgpack")
+
+# dB values below this are treated as "no signal" (log10 of zero)
+DB_FLOOR = -200.0
+
+
+def compress(data, compression, level=None):
+    if compression == "none":
+        return data
+    if compression == "deflate":
+        return zlib.compress(data, 1 if level is None else level)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    raise ValueError("Unknown compression %s" % compression)
+
+
+def decompress(data, compression):
+    if compression == "none":
+        return data
+    if compression == "deflate":
+        return zlib.decompress(data)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown compression %s" % compression)
+
+
+def quantize(freq_result, dtype):
+    if dtype == "f32":
+        return np.ascontiguousarray(freq_result, dtype="<f4"), 1.0, 0.0
+    clipped = np.clip(freq_result, DB_FLOOR, -DB_FLOOR)
+    if dtype == "f16":
+        return clipped.astype("<f2"), 1.0, 0.0
+    if dtype == "u8":
+        lo = float(clipped.min())
+        hi = float(clipped.max())
+        scale = (hi - lo)/255 if hi > lo else 1.0
+        levels = clipped - lo
+        levels /= scale
+        levels += .5
+        return levels.astype(np.uint8), scale, lo
+    raise ValueError("Unknown dtype %s" % dtype)
+
+
+def encode(freq_result, dtype="f16", compression="none", center_freq=0.0,
+           freq_res=0.0, time_res=0.0, image=b"", t_start=0.0):
+    rows, cols = freq_result.shape
+    values, scale, offset = quantize(freq_result, dtype)
+    payload = compress(values.tobytes(), compression)
+    header = HEADER.pack(MAGIC, VERSION, DTYPES[dtype],
+                         COMPRESSIONS[compression], 0, rows, cols,
+                         scale, offset, center_freq, freq_res, time_res,
+                         t_start, len(image))
+    return b"".join((header, image, payload))
+
+
+def decode(frame):
+    magic, version = struct.unpack_from("<4sB", frame)
+    if magic != MAGIC or version not in HEADERS:
+        raise ValueError("Not a version %s spectrum frame" %
+                         "/".join(str(v) for v in HEADERS))
+    layout = HEADERS[version]
+    fields = list(layout.unpack_from(frame))
+    if version == 1:
+        fields.insert(-1, 0.0)
+    (_, _, dtype_code, compression_code, _, rows, cols, scale, offset,
+     center_freq, freq_res, time_res, t_start, image_len) = fields
+    dtype = {v: k for k, v in DTYPES.items()}[dtype_code]
+    compression = {v: k for k, v in COMPRESSIONS.items()}[compression_code]
+
+    start = layout.size
+    image = bytes(frame[start:start+image_len])
+    payload = decompress(bytes(frame[start+image_len:]), compression)
+    np_dtype = {"f32": "<f4", "f16": "<f2", "u8": np.uint8}[dtype]
+    values = np.frombuffer(payload, dtype=np_dtype).reshape(rows, cols)
+    freq_result = values.astype(np.float32)
+    if dtype == "u8":
+        freq_result *= scale
+        freq_result += offset
+
+    header = {
+        "dtype": dtype,
+        "compression": compression,
+        "shape": (rows, cols),
+        "scale": scale,
+        "offset": offset,
+        "center_freq": center_freq,
+        "freq_res": freq_res,
+        "time_res": time_res,
+        "t_start": t_start,
+    }
+    return freq_result, header, image
+
+
+def pack_msgpack(room, frame):
+    import msgpack
+    return msgpack.packb({"room": room, "frame": frame}, use_bin_type=True)
+
+
+def unpack_msgpack(body):
+    import msgpack
+    message = msgpack.unpackb(body, raw=False)
+    return message["room"], message["frame"]
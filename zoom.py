@@ -0,0 +1,103 @@
+import numpy as np
+
+from fft_engine import WINDOWS
+
+
+def lowpass_taps(decimation, taps_per_phase=16, window="blackman"):
+    # windowed sinc with its cutoff at the output Nyquist frequency, padded
+    # to a whole number of taps per polyphase branch
+    n_taps = taps_per_phase*decimation
+    n = np.arange(n_taps) - (n_taps - 1)/2
+    taps = np.sinc(n/decimation)/decimation*WINDOWS[window](n_taps)
+    return taps.astype(np.float32)
+
+
+def polyphase_decimate(samples, taps, decimation):
+    # FIR filter and keep every decimation-th output, computed only for the
+    # kept outputs: the input is cut into blocks of `decimation` samples
+    # and every branch of the filter is one matrix-vector product over all
+    # blocks. Only outputs with a full filter history are returned.
+    n_phases = len(taps)//decimation
+    branches = taps[:n_phases*decimation].reshape(n_phases, decimation)
+    branches = branches[:, ::-1].astype(np.complex64)
+    n_blocks = samples.shape[-1]//decimation
+    n_out = n_blocks - n_phases + 1
+    if n_out < 1:
+        raise ValueError("Need at least %d samples to decimate by %d" %
+                         (n_phases*decimation, decimation))
+    blocks = samples[..., :n_blocks*decimation].reshape(
+        samples.shape[:-1] + (n_blocks, decimation))
+
+    out = blocks[..., n_phases-1:n_phases-1+n_out, :] @ branches[0]
+    for phase in range(1, n_phases):
+        start = n_phases - 1 - phase
+        out += blocks[..., start:start+n_out, :] @ branches[phase]
+    return out
+
+
+class ZoomFft():
+    # High resolution spectrogram of a narrow sub-band: the sub-band is
+    # mixed down to DC, low pass filtered and decimated in one polyphase
+    # pass, and only the decimated stream is transformed. For the same
+    # fft_size the bins are `decimation` times narrower, at roughly
+    # taps_per_phase multiply-adds per input sample plus the mixing.
+    fft_engine = None
+    taps_per_phase = 16
+    filter_window = "blackman"
+    oversample = 1.25
+    _mixers = None
+    _taps = None
+
+    def __init__(self, fft_engine, taps_per_phase=16, filter_window="blackman",
+                 oversample=1.25):
+        self.fft_engine = fft_engine
+        self.taps_per_phase = taps_per_phase
+        self.filter_window = filter_window
+        self.oversample = oversample
+        self._mixers = {}
+        self._taps = {}
+
+    def decimation(self, rate, span):
+        # keep some room for the filter transition band beyond the span
+        return max(1, int(rate // (span*self.oversample)))
+
+    def output_rate(self, rate, span):
+        return rate/self.decimation(rate, span)
+
+    def get_mixer(self, n_samples, offset, rate):
+        key = (n_samples, offset, rate)
+        mixer = self._mixers.get(key)
+        if mixer is None:
+            if len(self._mixers) > 16:
+                self._mixers.clear()
+            phase = -2*np.pi*offset/rate*np.arange(n_samples)
+            mixer = np.exp(1j*phase).astype(np.complex64)
+            self._mixers[key] = mixer
+        return mixer
+
+    def get_taps(self, decimation):
+        taps = self._taps.get(decimation)
+        if taps is None:
+            taps = lowpass_taps(decimation, self.taps_per_phase,
+                                self.filter_window)
+            self._taps[decimation] = taps
+        return taps
+
+    def downconvert(self, samples, rate, offset, span):
+        # (..., n) at `rate` -> (..., m) at output_rate(), `offset` Hz from
+        # the center moved to DC
+        decimation = self.decimation(rate, span)
+        samples = np.asarray(samples, dtype=np.complex64)
+        mixed = samples*self.get_mixer(samples.shape[-1], offset, rate)
+        if decimation == 1:
+            return mixed
+        return polyphase_decimate(mixed, self.get_taps(decimation),
+                                  decimation)
+
+    def psd(self, samples, rate, offset, span, fft_size, window="hamming",
+            pfb_taps=0, folded=True):
+        baseband = self.downconvert(samples, rate, offset, span)
+        if pfb_taps:
+            return self.fft_engine.pfb_psd(baseband, fft_size, pfb_taps,
+                                           window, folded=folded)
+        return self.fft_engine.psd(baseband, fft_size, window, folded=folded)